@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Compare database lookup latency before and after the schema step.
+
+Before: the shipped database as a file, with queries built as f-strings.
+After: the same data opened by Database, which loads it in memory and keeps
+the geocodes in their own database, with a parameterized query. Places and
+capcodes are looked up in PlaceIndex and CapcodeIndex, their tables are
+dropped from the in-memory copy once those are built.
+
+Usage: python3 bench_database.py [p2000.sqlite3] [lookups]
+"""
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from capcodes import CapcodeIndex
+from p2000 import Database
+from places import PlaceIndex
+
+LEGACY = {
+    'city': "SELECT EXISTS(SELECT 1 FROM places WHERE city = '{}')",
+    'abbreviation': "SELECT city FROM places WHERE abbreviation = '{}'",
+    'capcode': "SELECT discipline, region, location, description, remark FROM capcodes WHERE capcode = '{}'",
+    'geocode': "SELECT latitude, longitude, address, mapurl FROM geocodes WHERE query = '{}'",
+}
+
+CURRENT_GEOCODE = "SELECT latitude, longitude, address, mapurl FROM store.geocodes WHERE query = ?"
+
+
+def sample_keys(dbpath, lookups):
+    """Return lookup keys per query, half of them existing."""
+
+    db = sqlite3.connect(dbpath)
+    keys = {}
+    for name, sql in (('city', "SELECT city FROM places"), ('abbreviation', "SELECT abbreviation FROM places WHERE abbreviation != ''"),
+                      ('capcode', "SELECT capcode FROM capcodes"), ('geocode', "SELECT query FROM geocodes")):
+        values = [row[0] for row in db.execute(sql)] or ["Unknown"]
+        keys[name] = [random.choice(values) if number % 2 else f"Unknown {number}" for number in range(lookups)]
+    db.close()
+    return keys
+
+
+def run(lookup, keys):
+    """Return the mean time per lookup in microseconds."""
+
+    started = time.perf_counter()
+    for key in keys:
+        lookup(key)
+    return (time.perf_counter() - started) / len(keys) * 1e6
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'p2000.sqlite3')
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    keys = sample_keys(source, lookups)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The geocodes of a database next to the new one are moved into it
+        before = os.path.join(tmp, 'p2000.sqlite3')
+        shutil.copy(source, before)
+
+        legacy = sqlite3.connect(before).cursor()
+        database = Database(os.path.join(tmp, 'geocodes.sqlite3'), reference=source)
+        places = PlaceIndex(database.load_places())
+        capcodes = CapcodeIndex(database.load_capcodes())
+        database.drop_loaded_tables()
+        current = {
+            'city': places.is_city,
+            'abbreviation': places.find_city,
+            'capcode': capcodes.resolve,
+            'geocode': lambda key: database.cursor.execute(CURRENT_GEOCODE, (key,)).fetchone(),
+        }
+
+        print(f"{lookups} lookups per query, half of them unknown")
+        for name in LEGACY:
+            old = run(lambda key: legacy.execute(LEGACY[name].format(key.replace("'", ""))).fetchone(), keys[name])
+            new = run(current[name], keys[name])
+            print(f"{name:13s} before: {old:8.1f} us   after: {new:8.1f} us ({old / new:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Compare the memory used by a message in flight, before and after slotting MessageItem.
+
+Before: the MessageItem of the original add-on, with a per-instance dict.
+After: the slotted MessageItem, its lists and distances dict are only made once they are needed.
+
+Usage: python3 bench_messages.py [messages]
+"""
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from p2000 import MessageItem
+
+
+class LegacyMessageItem:
+    """MessageItem as it was, without slots."""
+
+    def __init__(self):
+        self.timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.message_raw = ""
+        self.timestamp = ""
+        self.timereceived = time.monotonic()
+        self.groupid = ""
+        self.receivers = ""
+        self.capcodes = []
+        self.body = ""
+        self.location = ""
+        self.postalcode = ""
+        self.city = ""
+        self.address = ""
+        self.street = ""
+        self.region = ""
+        self.priority = 0
+        self.disciplines = ""
+        self.remarks = ""
+        self.longitude = ""
+        self.latitude = ""
+        self.opencage = ""
+        self.mapurl = ""
+        self.distance = ""
+        self.tts = ""
+
+
+def footprint(factory, count):
+    """Return the bytes allocated per message."""
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [factory() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del messages
+    return (after - before) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    # Empty messages, so only the objects and their containers are counted, not the strings
+    legacy = footprint(LegacyMessageItem, count)
+    slotted = footprint(MessageItem, count)
+    print(f"per message: {legacy:6.0f} bytes with a dict, {slotted:6.0f} bytes with slots")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Compare publishing with a connection per message and with the long-lived MqttSender.
+
+Before: paho.mqtt.publish.single, a connect, CONNECT/DISCONNECT and will per publish.
+After: MqttSender, one connection with its own network loop, every publish with QoS 1.
+
+Needs a running broker.
+
+Usage: python3 bench_mqtt.py [host] [port] [messages]
+"""
+import os
+import sys
+import time
+
+import paho.mqtt.publish as publish
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mqttsender import MqttSender
+
+
+def main():
+    host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 1883
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    topic = 'p2000_rtlsdr_bench/sensor/attributes'
+    will = {'topic': 'p2000_rtlsdr_bench/status', 'payload': 'offline', 'qos': 1, 'retain': True}
+
+    started = time.perf_counter()
+    for number in range(count):
+        publish.single(topic, payload=str(number), hostname=host, port=port, client_id='p2000_rtlsdr_bench', keepalive=60, will=will)
+    legacy = (time.perf_counter() - started) / count * 1e3
+
+    sender = MqttSender({'host': host, 'port': port, 'base_topic': 'p2000_rtlsdr_bench', 'client_id': 'p2000_rtlsdr_bench'}, False)
+    while not sender.stats()['connected']:
+        time.sleep(0.01)
+    started = time.perf_counter()
+    for number in range(count):
+        sender.publish(topic=topic, payload=str(number))
+    call = (time.perf_counter() - started) / count * 1e6
+    # Until all of them are acknowledged
+    while sender.stats()['acknowledged'] < sender.stats()['published']:
+        time.sleep(0.001)
+    total = (time.perf_counter() - started) / count * 1e3
+    stats = sender.stats()
+    sender.close()
+
+    print(f"{count} publishes to {host}:{port}")
+    print(f"publish.single:        {legacy:8.2f} ms per message")
+    print(f"MqttSender:            {total:8.2f} ms per message until acknowledged ({legacy / total:.0f}x), "
+          f"{call:.0f} us in publish()")
+    print(f"MqttSender latency: mean {stats['latency_mean'] * 1000:.2f} ms, max {stats['latency_max'] * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Measure the OpenCage client against the local stand-in server.
+
+Compares a bare requests.get per query with the pooled client, then checks
+retries of failing requests and that the rate limit is picked up.
+
+Usage: python3 bench_opencage.py [queries] [latency]
+"""
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geocoder import OpenCageClient, RateLimitExceededError
+from opencage_stub import start_stub
+
+QUERY = "Schiedamseweg 3134 BA Vlaardingen"
+
+
+def bare_get(url, query):
+    """A query the way it was done before, a new connection every time."""
+
+    params = {'q': query, 'key': 'stub', 'limit': 1, 'country': 'nl', 'language': 'nl'}
+    return requests.get(url, params=params, timeout=5).json()
+
+
+def run(function, count):
+    """Return the number of queries per second."""
+
+    started = time.perf_counter()
+    for number in range(count):
+        function(f"{QUERY} {number}")
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+
+    server, url = start_stub(latency=latency, limit=10 * count)
+    client = OpenCageClient('stub', url=url)
+    bare = run(lambda query: bare_get(url, query), count)
+    connections = len(server.state.connections)
+    pooled = run(client.geocode, count)
+    print(f"{count} queries, {latency * 1000:.0f} ms server latency")
+    print(f"requests.get per query: {bare:8.1f} queries/s, {connections} connections")
+    print(f"pooled client:          {pooled:8.1f} queries/s, {len(server.state.connections) - connections} connections")
+    server.shutdown()
+
+    # A third of the requests fail, the retries should hide nearly all of them
+    server, url = start_stub(failures=0.33, limit=10 * count)
+    client = OpenCageClient('stub', url=url, backoff=0.01)
+    failed = 0
+    for number in range(count):
+        try:
+            client.geocode(f"{QUERY} {number}")
+        except Exception:
+            failed += 1
+    print(f"33% server errors: {failed} of {count} queries failed after retries, {server.state.requests} requests sent")
+    server.shutdown()
+
+    # The rate block is followed until the daily limit runs out
+    server, url = start_stub(limit=5)
+    client = OpenCageClient('stub', url=url)
+    for number in range(10):
+        try:
+            client.geocode(f"{QUERY} {number}")
+        except RateLimitExceededError as err:
+            print(f"rate limit after {number} queries, limited: {client.rate_limited()}, {err}")
+            break
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Compare the FLEX line parser with the old inline parsing code.
+
+Usage: python3 bench_parser.py [corpus file] [rounds]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flexparser import parse_line
+
+
+def legacy_get_prio(message):
+    """Priority lookup as it was done before, patterns are looked up per call."""
+
+    priority = 0
+    regex_prio1 = r"^A\s?1|\s?A\s?1|PRIO\s?1|^P\s?1"
+    regex_prio2 = r"^A\s?2|\s?A\s?2|PRIO\s?2|^P\s?2"
+    regex_prio3 = r"^B\s?1|^B\s?2|^B\s?3|PRIO\s?3|^P\s?3"
+    regex_prio4 = r"^PRIO\s?4|^P\s?4"
+
+    if re.search(regex_prio1, message, re.IGNORECASE):
+        priority = 1
+    elif re.search(regex_prio2, message, re.IGNORECASE):
+        priority = 2
+    elif re.search(regex_prio3, message, re.IGNORECASE):
+        priority = 3
+    elif re.search(regex_prio4, message, re.IGNORECASE):
+        priority = 4
+
+    return priority
+
+
+def legacy_parse(line):
+    """The parsing steps receive_thread_call did inline before flexparser existed."""
+
+    line_data = line.split("|")
+    timestamp = line_data[1]
+    groupid = line_data[3].strip()
+    capcodes = line_data[4].strip()
+    message = line_data[6].strip()
+    priority = legacy_get_prio(message)
+    raw = line.strip()
+    addr = re.search(r"(\w*.) ([1-9][0-9]{3})([A-Z]{2})? (.\w*)", message)
+    if addr:
+        address = f"{addr.group(1)} {addr.group(2)} {addr.group(3)} {addr.group(4)}"
+        return timestamp, groupid, capcodes.split(" "), message, priority, raw, address
+    loc = re.search(r"(^A\s?1|\s?A\s?2|B\s?1|^B\s?2|^B\s?3|PRIO\s?1|^P\s?1|PRIO\s?2|^P\s?2) (.\w*)", message)
+    afkortingen = re.findall("[A-Z]{3,}", message)
+    strip = re.sub(r"(^A\s?1|\s?A\s?2|B\s?1|^B\s?2|^B\s?3|PRIO\s?1|^P\s?1|PRIO\s?2|^P\s?2|^PRIO\s?3|^P\s?3|^PRIO\s?4|^P\s?4)(\W\d{2,}|.*(BR)\b|)|(rit:|rit|bon|bon:|ambu|dia)\W\d{5,8}|\b\d{5,}$|( : )|\(([^\)]+)\)( \b\d{5,}|)|directe (\w*)|(-)+/gi", "", message, flags=re.I)
+    strip = re.sub(r"(^[ \t]+|[ \t]+$)", "", strip.strip())
+    return timestamp, groupid, capcodes.split(" "), message, priority, raw, loc, afkortingen, strip
+
+
+def current_parse(line):
+    """Same work using flexparser."""
+
+    record = parse_line(line)
+    if not record.address:
+        record.stripped()
+    return record
+
+
+def run(function, lines, rounds):
+    """Return the mean time per line in microseconds, best of rounds."""
+
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for line in lines:
+            function(line)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(lines) * 1e6
+
+
+def main():
+    corpus = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.txt')
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with open(corpus, encoding='utf8') as f:
+        lines = [line for line in f if line.startswith('FLEX') and '|ALN|' in line]
+
+    legacy = run(legacy_parse, lines, rounds)
+    current = run(current_parse, lines, rounds)
+    print(f"{len(lines)} lines, best of {rounds} rounds")
+    print(f"legacy inline parsing: {legacy:8.2f} us/line")
+    print(f"flexparser:            {current:8.2f} us/line ({legacy / current:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Compare building the sensor attribute payloads per sensor and once per message.
+
+Before: for every matching sensor the attributes dict is built, serialized with
+json.dumps and the topic is concatenated.
+After: Main.encode_attributes serializes a message once, every sensor gets the
+same bytes with its distance in between, the topics are built at startup.
+
+Usage: python3 bench_payloads.py [sensors per message] [rounds]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flexparser import parse_line
+from p2000 import Main, MessageItem
+
+
+def make_messages(corpus):
+    """Return messages from the corpus with the enriched fields filled in."""
+
+    messages = []
+    with open(corpus, encoding='utf8') as f:
+        for number, line in enumerate(f):
+            record = parse_line(line) if line.startswith('FLEX') else None
+            if record is None:
+                continue
+            msg = MessageItem()
+            msg.message_raw = line.strip()
+            msg.timestamp = "2024-01-01 12:00:00"
+            msg.body = record.body
+            msg.capcodes = record.capcodes
+            msg.receivers = "Brandweer Rotterdam-Rijnmond (Kazerne Vlaardingen)"
+            msg.region = "Rotterdam-Rijnmond"
+            msg.disciplines = ["Brandweer"]
+            msg.city = "Vlaardingen"
+            msg.latitude, msg.longitude = 51.9125, 4.3419
+            msg.mapurl = f"https://www.openstreetmap.org/?mlat={msg.latitude}&mlon={msg.longitude}&zoom=15&layers=M"
+            msg.tts = record.body
+            msg.distances = {str(number): number * 0.25 for number in range(0, 40, 3)}
+            messages.append(msg)
+    return messages
+
+
+def legacy_publish(sensors, msg, publish):
+    """What publish_sensor did for every matching sensor before."""
+
+    for id, sensor in sensors.items():
+        attributes = {
+            "time received": msg.timestamp,
+            "group id": msg.groupid,
+            "receivers": msg.receivers,
+            "capcodes": msg.capcodes,
+            "priority": msg.priority,
+            "disciplines": ", ".join(msg.disciplines),
+            "raw message": msg.message_raw,
+            "region": msg.region,
+            "location": msg.location,
+            "postal code": msg.postalcode,
+            "city": msg.city,
+            "address": msg.address,
+            "street": msg.street,
+            "remarks": msg.remarks,
+            "longitude": msg.longitude,
+            "latitude": msg.latitude,
+            "opencage": msg.opencage,
+            "mapurl": msg.mapurl,
+            "distance": msg.distances.get(id, ""),
+            "tts": msg.tts,
+        }
+        publish('homeassistant/sensor/' + sensor['attribute_topic'], json.dumps(attributes).encode())
+
+
+def current_publish(main, sensors, msg, publish):
+    """What post_data and publish_sensor do now."""
+
+    head, tail = main.encode_attributes(msg)
+    for id, sensor in sensors.items():
+        publish(sensor['full_attribute_topic'], head + json.dumps(msg.distances.get(id, "")).encode() + tail)
+
+
+def run(fan_out, messages, rounds):
+    """Return the mean time per message in microseconds and the payloads, best of rounds."""
+
+    best = None
+    for _ in range(rounds):
+        payloads = []
+        publish = lambda topic, payload: payloads.append((topic, payload))
+        started = time.perf_counter()
+        for msg in messages:
+            fan_out(msg, publish)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(messages) * 1e6, payloads
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    messages = make_messages(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.txt'))
+    sensors = {}
+    for number in range(count):
+        attribute_topic = f"p2000_rtlsdr/{number}/attributes"
+        sensors[str(number)] = {'attribute_topic': attribute_topic, 'full_attribute_topic': 'homeassistant/sensor/' + attribute_topic}
+    app = Main.__new__(Main)
+
+    legacy, expected = run(lambda msg, publish: legacy_publish(sensors, msg, publish), messages, rounds)
+    current, payloads = run(lambda msg, publish: current_publish(app, sensors, msg, publish), messages, rounds)
+    print(f"{len(messages)} messages, each published to {count} sensors, best of {rounds} rounds")
+    print(f"dict + json.dumps per sensor: {legacy:8.1f} us/message")
+    print(f"encoded once per message:     {current:8.1f} us/message ({legacy / current:.1f}x), "
+          f"{'same payloads' if payloads == expected else 'DIFFERENT payloads'}")
+
+
+if __name__ == '__main__':
+    main()
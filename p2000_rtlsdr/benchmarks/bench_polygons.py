@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Compare point in polygon checks against every polygon with the PolygonZones grid.
+
+Before: a ray cast over all edges of every polygon whose bounding box holds the location.
+After: PolygonZones, which only looks at the edges in the grid cell of the location.
+
+The polygons are generated municipality sized shapes, or the features of a
+GeoJSON file when one is given.
+
+Usage: python3 bench_polygons.py [polygons|file.geojson] [vertices] [locations]
+"""
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zones import PolygonZones, crosses
+
+# Roughly the Netherlands
+LATITUDES = (50.75, 53.55)
+LONGITUDES = (3.35, 7.2)
+
+
+def make_polygon(vertices):
+    """Return the rings of a wobbly polygon of 2 to 20 km across, every third one with a hole."""
+
+    longitude, latitude = random.uniform(*LONGITUDES), random.uniform(*LATITUDES)
+    radius = random.uniform(0.02, 0.2)
+    phase = random.uniform(0, math.pi)
+    ring = []
+    for number in range(vertices):
+        angle = 2 * math.pi * number / vertices
+        distance = radius * (0.75 + 0.2 * math.sin(5 * angle + phase) + 0.05 * random.random())
+        # A degree of longitude is about 0.6 of a degree of latitude here
+        ring.append((longitude + distance * math.cos(angle) * 1.6, latitude + distance * math.sin(angle)))
+    ring.append(ring[0])
+    rings = [ring]
+    if random.random() < 1 / 3:
+        rings.append([(x + (longitude - x) * 0.9, y + (latitude - y) * 0.9) for x, y in ring[::10]] + [ring[0]])
+    return rings
+
+
+def load_features(filename):
+    """Return every feature of a GeoJSON file as its own zone."""
+
+    with open(filename, encoding='utf8') as f:
+        features = json.load(f).get('features', [])
+    zones = []
+    for number, feature in enumerate(features):
+        geometry = feature.get('geometry') or {}
+        polygons = [geometry['coordinates']] if geometry.get('type') == 'Polygon' else geometry.get('coordinates', [])
+        rings = [[(float(x), float(y)) for x, y, *_ in ring] for polygon in polygons for ring in polygon]
+        if rings:
+            zones.append((str(number), rings))
+    return zones
+
+
+def brute_force(zones):
+    """Return a check function that ray casts over all polygons."""
+
+    polygons = []
+    for id, rings in zones:
+        edges = [(x1, y1, x2, y2) for ring in rings for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]) if (x1, y1) != (x2, y2)]
+        points = [point for ring in rings for point in ring]
+        box = (min(x for x, _ in points), min(y for _, y in points), max(x for x, _ in points), max(y for _, y in points))
+        polygons.append((id, box, edges))
+
+    def check(latitude, longitude):
+        return [
+            id for id, (west, south, east, north), edges in polygons
+            if west <= longitude <= east and south <= latitude <= north and crosses(edges, longitude, latitude)
+        ]
+    return check
+
+
+def run(check, locations):
+    """Return the mean time per location in microseconds and the results."""
+
+    results = []
+    started = time.perf_counter()
+    for latitude, longitude in locations:
+        results.append(sorted(check(latitude, longitude)))
+    return (time.perf_counter() - started) / len(locations) * 1e6, results
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else '350'
+    vertices = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    lookups = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    random.seed(2000)
+    zones = load_features(source) if not source.isdigit() else [(str(number), make_polygon(vertices)) for number in range(int(source))]
+    edges = sum(len(ring) for _, rings in zones for ring in rings)
+
+    points = [point for _, rings in zones for ring in rings for point in ring]
+    west, east = min(x for x, _ in points), max(x for x, _ in points)
+    south, north = min(y for _, y in points), max(y for _, y in points)
+    locations = [(random.uniform(south, north), random.uniform(west, east)) for _ in range(lookups)]
+
+    started = time.perf_counter()
+    grid = PolygonZones(zones)
+    built = time.perf_counter() - started
+
+    legacy, expected = run(brute_force(zones), locations)
+    current, results = run(grid.check, locations)
+    print(f"{len(zones)} polygons with {edges} edges, {lookups} locations, {sum(map(len, expected))} inside a polygon")
+    print(f"grid of {grid.columns}x{grid.rows} cells ({len(grid.grid)} used) built in {built:.2f} s")
+    print(f"ray cast per polygon: {legacy:9.1f} us/location")
+    print(f"PolygonZones:         {current:9.1f} us/location ({legacy / current:.1f}x), "
+          f"{'same result' if results == expected else 'DIFFERENT result'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Compare matching messages against many sensors, before and after compiling the criteria.
+
+Before: for every message and sensor the criteria are split from the config
+strings and every pattern goes through fnmatch.fnmatch.
+After: SensorMatcher, with one precompiled regex per criterion, for all
+sensors and for only the candidates SensorIndex finds.
+
+Usage: python3 bench_sensors.py [sensors] [rounds] [mixed|stations]
+"""
+import fnmatch
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flexparser import parse_line
+from p2000 import MessageItem
+from sensors import SensorIndex, SensorMatcher
+from utils import log_message
+
+REGIONS = ("Rotterdam-Rijnmond", "Amsterdam-Amstelland", "Utrecht", "Haaglanden", "Kennemerland")
+DISCIPLINES = ("Brandweer", "Ambulance", "Politie", "KNRM")
+
+
+def check_filter(mylist, text):
+    """The old filter check."""
+
+    if len(mylist) == 0:
+        return True
+    for f_str in mylist:
+        if fnmatch.fnmatch(text, f_str):
+            return True
+    return False
+
+
+def check_filter_with_list(searchlist, list_to_be_searched):
+    """The old filter check for a list of texts."""
+
+    if len(searchlist) == 0:
+        return True
+    for searchedtext in list_to_be_searched:
+        if check_filter(searchlist, searchedtext) == True:
+            return True
+    return False
+
+
+def legacy_match(sensor, msg, debug=False):
+    """The checks post_data did per sensor before, with the remark check fixed."""
+
+    searchkeyword = sensor['keyword'].split(',') if 'keyword' in sensor else ''
+    searchcapcode = sensor['capcode'].split(',') if 'capcode' in sensor else ''
+    searchregion = sensor['region'].split(',') if 'region' in sensor else ''
+    searchdiscipline = sensor['discipline'].split(',') if 'discipline' in sensor else ''
+    searchlocation = sensor['location'].split(',') if 'location' in sensor else ''
+    searchremark = sensor['remark'].split(',') if 'remark' in sensor else ''
+    post = False
+    for patterns, text, label in ((searchkeyword, msg.body, 'Keywords'), (searchregion, msg.region, 'Regions'),
+                                  (searchlocation, msg.location, 'Locations'), (searchremark, msg.remarks, 'Remarks'),
+                                  (searchregion, msg.region, 'Regions')):
+        if len(patterns):
+            if not check_filter(patterns, text):
+                log_message(f"{label} UNMATCHED '{', '.join(patterns)}'", debug)
+                return False
+            log_message(f"{label} MATCHED '{', '.join(patterns)}'", debug)
+            post = True
+    if len(searchcapcode):
+        if not check_filter_with_list(searchcapcode, msg.capcodes):
+            log_message(f"Capcodes UNMATCHED '{', '.join(searchcapcode)}'", debug)
+            return False
+        log_message(f"Capcodes MATCHED '{', '.join(msg.capcodes)}'", debug)
+        post = True
+    if len(searchdiscipline):
+        if not check_filter_with_list(searchdiscipline, msg.disciplines):
+            log_message(f"Disciplines UNMATCHED '{', '.join(searchdiscipline)}'", debug)
+            return False
+        log_message(f"Disciplines MATCHED '{', '.join(msg.disciplines)}'", debug)
+        post = True
+    return post
+
+
+def make_sensors(count, capcodes, stations_only):
+    """Return count sensor configs: mostly one per station capcode, some per region and keyword."""
+
+    sensors = {}
+    for number in range(count):
+        kind = 0 if stations_only else number % 10
+        if kind < 6:
+            capcode = capcodes[number % len(capcodes)] if number < len(capcodes) else f"{random.randrange(10 ** 8):09d}"
+            sensor = {'capcode': capcode}
+        elif kind < 8:
+            sensor = {'region': random.choice(REGIONS), 'discipline': random.choice(DISCIPLINES)}
+        elif kind < 9:
+            sensor = {'keyword': "*GRIP*,*Grip*,*grip*"}
+        else:
+            sensor = {'capcode': f"*{random.randrange(10 ** 4):04d}*", 'remark': "*heli*"}
+        sensors[str(number)] = sensor
+    return sensors
+
+
+def make_messages(corpus):
+    """Return messages from the corpus with some capcode info filled in."""
+
+    messages = []
+    with open(corpus, encoding='utf8') as f:
+        for number, line in enumerate(f):
+            record = parse_line(line) if line.startswith('FLEX') else None
+            if record is None:
+                continue
+            msg = MessageItem()
+            msg.body = record.body
+            msg.capcodes = record.capcodes
+            msg.region = REGIONS[number % len(REGIONS)]
+            msg.disciplines = [DISCIPLINES[number % len(DISCIPLINES)]]
+            msg.remarks = "Traumaheli" if number % 7 == 0 else ""
+            messages.append(msg)
+    return messages
+
+
+def run(match, sensors, messages, rounds):
+    """Return the mean time per message in microseconds and the number of matches, best of rounds."""
+
+    best = None
+    for _ in range(rounds):
+        matched = 0
+        started = time.perf_counter()
+        for msg in messages:
+            for sensor in sensors:
+                if match(sensor, msg):
+                    matched += 1
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(messages) * 1e6, matched
+
+
+def run_indexed(matchers, index, messages, rounds):
+    """Return the mean time per message in microseconds and the number of matches, best of rounds."""
+
+    best = None
+    for _ in range(rounds):
+        matched = 0
+        started = time.perf_counter()
+        for msg in messages:
+            for id in index.candidates(msg):
+                if matchers[id].match(msg):
+                    matched += 1
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(messages) * 1e6, matched
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    stations_only = len(sys.argv) > 3 and sys.argv[3] == 'stations'
+    random.seed(2000)
+    messages = make_messages(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.txt'))
+    capcodes = sorted({capcode for msg in messages for capcode in msg.capcodes})
+    configs = make_sensors(count, capcodes, stations_only)
+
+    started = time.perf_counter()
+    matchers = {id: SensorMatcher(id, sensor) for id, sensor in configs.items()}
+    index = SensorIndex(matchers)
+    compiled = (time.perf_counter() - started) * 1000
+
+    legacy, legacy_matched = run(legacy_match, list(configs.values()), messages, rounds)
+    current, current_matched = run(lambda matcher, msg: matcher.match(msg), list(matchers.values()), messages, rounds)
+    indexed, indexed_matched = run_indexed(matchers, index, messages, rounds)
+    print(f"{count} sensors ({len(index.fallback)} with wildcards only), {len(messages)} messages, "
+          f"best of {rounds} rounds, compiling took {compiled:.1f} ms")
+    print(f"split + fnmatch:  {legacy:9.1f} us/message, {legacy_matched} matches")
+    print(f"SensorMatcher:    {current:9.1f} us/message, {current_matched} matches ({legacy / current:.1f}x)")
+    print(f"SensorIndex:      {indexed:9.1f} us/message, {indexed_matched} matches ({legacy / indexed:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
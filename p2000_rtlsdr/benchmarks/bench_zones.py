@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Compare checking the zone sensors with geodesic per sensor and with CircleZones.
+
+Before: the geodesic distance from every zone centre to the location.
+After: one haversine pass over all zones, with numpy and without it, and the
+geodesic distance only for the zones near enough to be inside.
+
+Usage: python3 bench_zones.py [zones] [locations]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geopy.distance import geodesic
+
+import zones
+from zones import CircleZones
+
+# Roughly the Netherlands
+LATITUDES = (50.75, 53.55)
+LONGITUDES = (3.35, 7.2)
+
+
+def legacy_check(zone_list, latitude, longitude):
+    """Return the ids and distances of the zones that contain the location, like post_data did."""
+
+    inside = {}
+    for id, zone_latitude, zone_longitude, radius in zone_list:
+        distance = round(geodesic((zone_latitude, zone_longitude), (latitude, longitude)).km, 2)
+        if distance <= radius:
+            inside[id] = distance
+    return inside
+
+
+def current_check(circles, latitude, longitude):
+    """Same result from CircleZones."""
+
+    circles, radii = circles
+    return {id: distance for id, distance in circles.check(latitude, longitude).items() if distance <= radii[id]}
+
+
+def run(check, zone_set, locations):
+    """Return the mean time per location in microseconds and the results."""
+
+    results = []
+    started = time.perf_counter()
+    for latitude, longitude in locations:
+        results.append(check(zone_set, latitude, longitude))
+    return (time.perf_counter() - started) / len(locations) * 1e6, results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    random.seed(2000)
+    zone_list = [
+        (str(number), round(random.uniform(*LATITUDES), 4), round(random.uniform(*LONGITUDES), 4), random.choice((2, 5, 10, 25)))
+        for number in range(count)
+    ]
+    locations = [(random.uniform(*LATITUDES), random.uniform(*LONGITUDES)) for _ in range(lookups)]
+
+    legacy, expected = run(legacy_check, zone_list, locations)
+    print(f"{count} zones, {lookups} locations, {sum(map(len, expected)) / lookups:.1f} zones matched per location")
+    print(f"geodesic per zone:       {legacy:9.1f} us/location")
+
+    numpy = zones.numpy
+    for name, module in (('CircleZones with numpy:', numpy), ('CircleZones without:', None)):
+        if name.endswith('numpy:') and numpy is None:
+            print(f"{name:24s} numpy not installed")
+            continue
+        zones.numpy = module
+        circles = CircleZones(zone_list)
+        current, results = run(current_check, (circles, dict(zip(circles.ids, circles.radii))), locations)
+        same = 'same result' if results == expected else 'DIFFERENT result'
+        print(f"{name:24s} {current:9.1f} us/location ({legacy / current:.1f}x), {same}")
+    zones.numpy = numpy
+
+
+if __name__ == '__main__':
+    main()
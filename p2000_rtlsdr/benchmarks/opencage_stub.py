@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Local stand-in for the OpenCage geocoding API.
+
+Answers /geocode/v1/json with a result in the city named by the last word of
+the query, and a rate block like the free trial accounts get. Point the
+add-on at it with `opencage: url: http://host:8080/geocode/v1/json`.
+
+Usage: python3 opencage_stub.py [--port 8080] [--latency 0.05] [--failures 0.1] [--limit 2500]
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubState:
+    """Behaviour and counters shared by all request handlers."""
+
+    def __init__(self, latency=0.0, failures=0.0, limit=2500):
+        self.latency = latency
+        self.failures = failures
+        self.limit = limit
+        self.remaining = limit
+        self.reset = int(time.time()) + 24 * 3600
+        self.requests = 0
+        self.errors = 0
+        self.connections = set()
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Handle one geocode request."""
+
+    protocol_version = 'HTTP/1.1'
+    # Keep-alive answers are written in two parts, don't let them wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        if url.path != '/geocode/v1/json':
+            self.reply(404, {'status': {'code': 404, 'message': 'not found'}})
+            return
+
+        query = parse_qs(url.query)
+        with state.lock:
+            state.requests += 1
+            state.connections.add(self.client_address)
+            failed = random.random() < state.failures
+            exhausted = not failed and state.remaining <= 0
+            if failed:
+                state.errors += 1
+            elif not exhausted:
+                state.remaining -= 1
+            rate = {'limit': state.limit, 'remaining': state.remaining, 'reset': state.reset}
+
+        if state.latency:
+            time.sleep(state.latency)
+
+        if not query.get('key', [''])[0]:
+            self.reply(401, {'status': {'code': 401, 'message': 'invalid API key'}})
+        elif failed:
+            self.reply(503, {'status': {'code': 503, 'message': 'service unavailable'}})
+        elif exhausted:
+            self.reply(402, {'rate': rate, 'status': {'code': 402, 'message': 'quota exceeded'}})
+        else:
+            self.reply(200, self.result(query.get('q', [''])[0], rate))
+
+    @staticmethod
+    def result(query, rate):
+        """Return a response with one result in the city at the end of query."""
+
+        words = query.split()
+        city = words[-1] if words else ''
+        if not city:
+            return {'rate': rate, 'results': [], 'total_results': 0, 'status': {'code': 200, 'message': 'OK'}}
+        seed = sum(map(ord, query))
+        latitude = 51.0 + seed % 200 / 100
+        longitude = 4.0 + seed % 300 / 100
+        return {
+            'rate': rate,
+            'results': [{
+                'components': {'_type': 'building', 'city': city, 'road': words[0], 'postcode': ' '.join(words[1:-1])},
+                'geometry': {'lat': latitude, 'lng': longitude},
+                'annotations': {'OSM': {'url': f"https://www.openstreetmap.org/?mlat={latitude}&mlon={longitude}"}},
+            }],
+            'total_results': 1,
+            'status': {'code': 200, 'message': 'OK'},
+        }
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=0, latency=0.0, failures=0.0, limit=2500):
+    """Start the stub in a background thread, return the server and its url."""
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(latency, failures, limit)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/geocode/v1/json"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenCage API")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before each answer")
+    parser.add_argument('--failures', type=float, default=0.0, help="fraction of requests answered with a 503")
+    parser.add_argument('--limit', type=int, default=2500, help="requests per day before a 402 is returned")
+    args = parser.parse_args()
+
+    server, url = start_stub(args.port, args.latency, args.failures, args.limit)
+    print(f"OpenCage stub listening on {url}")
+    try:
+        while True:
+            time.sleep(60)
+            state = server.state
+            print(f"{state.requests} requests, {state.errors} failed, {state.remaining} remaining, {len(state.connections)} connections")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Bounded caches with hit, miss and eviction counters."""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Mapping with a size cap, least recently used entries are evicted first.
+
+    Entries older than ttl seconds are treated as missing, use None to keep them until evicted.
+    """
+
+    def __init__(self, maxsize, ttl=None, clock=time.monotonic):
+        """Initialize the cache, the ttl is measured with clock."""
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """Return the value for key and mark it as recently used, or default."""
+
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > self.clock():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        """Store value for key, evicting the least recently used entry when full."""
+
+        ttl = ttl or self.ttl
+        expires = self.clock() + ttl if ttl else None
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Return the counters."""
+
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class NegativeCache(LRUCache):
+    """Bounded set of keys that are known to give no result."""
+
+    def add(self, key, ttl=None):
+        """Remember that key gives no result."""
+
+        self.put(key, True, ttl)
+
+    def __contains__(self, key):
+        return self.get(key, False)
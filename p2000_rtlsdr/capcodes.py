@@ -0,0 +1,68 @@
+"""Compact in-memory index of the capcodes table."""
+import sys
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+CapcodeInfo = namedtuple('CapcodeInfo', 'discipline region location description remark')
+
+# Capcodes have 9 digits, so they fit in an unsigned 32 bit integer
+KEY_TYPE = 'I' if array('I').itemsize >= 4 else 'L'
+
+
+class CapcodeIndex:
+    """Capcode info stored as sorted integer keys with an index into a table of unique rows.
+
+    The keys and row numbers live in two flat arrays (4 bytes each per capcode) and
+    lookups use bisect, all strings are interned so repeated disciplines, regions
+    and locations are stored only once.
+    """
+
+    def __init__(self, rows):
+        """Build the index from (capcode, discipline, region, location, description, remark) rows."""
+
+        entries = []
+        for capcode, *columns in rows:
+            try:
+                key = int(capcode)
+            except (TypeError, ValueError):
+                continue
+            entries.append((key, tuple(sys.intern(value) if isinstance(value, str) else value for value in columns)))
+        # Stable sort, the first row of a duplicate capcode wins like it did with the query
+        entries.sort(key=lambda entry: entry[0])
+
+        self.keys = array(KEY_TYPE)
+        self.rows = array(KEY_TYPE)
+        self.infos = []
+        unique = {}
+        for key, columns in entries:
+            if self.keys and self.keys[-1] == key:
+                continue
+            number = unique.get(columns)
+            if number is None:
+                number = unique[columns] = len(self.infos)
+                self.infos.append(CapcodeInfo(*columns))
+            self.keys.append(key)
+            self.rows.append(number)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def resolve(self, capcode):
+        """Return the CapcodeInfo for a capcode, or None if it is unknown."""
+
+        try:
+            key = int(capcode)
+        except ValueError:
+            return None
+        keys = self.keys
+        position = bisect_left(keys, key)
+        if position < len(keys) and keys[position] == key:
+            return self.infos[self.rows[position]]
+        return None
+
+    def resolve_capcodes(self, capcodes):
+        """Return a list with the CapcodeInfo (or None) for every capcode."""
+
+        resolve = self.resolve
+        return [resolve(capcode) for capcode in capcodes]
@@ -0,0 +1,165 @@
+"""Supervised rtl_fm | multimon-ng decoder pipeline."""
+import os
+import select
+import signal
+import subprocess
+import time
+
+from utils import log_message
+
+
+class DecoderProcess:
+    """Run the decoder command and restart it when it exits or stops producing output."""
+
+    def __init__(self, cmd, stall_timeout=300, backoff_min=1, backoff_max=300, stable_after=60):
+        """Initialize the supervisor, the process is started when lines() is iterated."""
+
+        self.cmd = cmd
+        self.stall_timeout = stall_timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.running = True
+        self.process = None
+        self.buffer = bytearray()
+        self.started = 0
+        self.last_line = 0
+
+        # Statistics
+        self.restarts = 0
+        self.downtime = 0.0
+        self.down_since = None
+        self.last_exit_code = None
+
+    def start(self):
+        """Start the decoder pipeline in its own process group."""
+
+        log_message(f"RTL-SDR process starting with: {self.cmd}")
+        self.buffer.clear()
+        self.process = subprocess.Popen(
+            self.cmd, stdout=subprocess.PIPE, shell=True, start_new_session=True
+        )
+        self.started = self.last_line = time.monotonic()
+
+    def stop(self):
+        """Stop the supervisor and terminate the decoder pipeline.
+
+        The pipe is left to lines(), which may still be reading from it in another thread.
+        """
+
+        self.running = False
+        process = self.process
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def kill(self):
+        """Terminate all processes of the pipeline and collect the exit code."""
+
+        process = self.process
+        if process is None:
+            return
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+            except ProcessLookupError:
+                pass
+        process.stdout.close()
+        self.last_exit_code = process.returncode
+
+    def read_line(self, timeout):
+        """Return the next line, b'' at end of output or None when nothing arrived within timeout."""
+
+        deadline = time.monotonic() + timeout
+        fd = self.process.stdout.fileno()
+        while True:
+            index = self.buffer.find(b"\n")
+            if index >= 0:
+                line = bytes(self.buffer[:index + 1])
+                del self.buffer[:index + 1]
+                return line
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                return None
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                # Hand out a trailing partial line before reporting the end
+                line = bytes(self.buffer)
+                self.buffer.clear()
+                return line
+            self.buffer += chunk
+
+    def lines(self):
+        """Yield raw lines from the decoder, restarting it with exponential backoff when needed."""
+
+        backoff = self.backoff_min
+        self.start()
+        try:
+            while self.running:
+                line = self.read_line(1.0)
+                now = time.monotonic()
+
+                if line:
+                    if self.down_since is not None:
+                        self.downtime += now - self.down_since
+                        self.down_since = None
+                        log_message(f"RTL-SDR process is receiving data again, {self.restarts} restarts, {self.downtime:.0f} s downtime in total")
+                    if now - self.started >= self.stable_after:
+                        backoff = self.backoff_min
+                    self.last_line = now
+                    yield line
+                    continue
+
+                if line is None:
+                    if not self.stall_timeout or now - self.last_line < self.stall_timeout:
+                        continue
+                    reason = f"no data received for {self.stall_timeout} seconds"
+                    down_since = self.last_line
+                else:
+                    self.process.wait()
+                    reason = f"process exited with code {self.process.returncode}"
+                    down_since = now
+
+                if not self.running:
+                    break
+
+                self.kill()
+                if self.down_since is None:
+                    self.down_since = down_since
+                log_message(f"RTL-SDR {reason}, restarting in {backoff} seconds", True)
+
+                # Sleep in small steps so a shutdown is not delayed by the backoff
+                wake = time.monotonic() + backoff
+                while self.running and time.monotonic() < wake:
+                    time.sleep(min(0.5, wake - time.monotonic()))
+                if not self.running:
+                    break
+
+                backoff = min(backoff * 2, self.backoff_max)
+                self.restarts += 1
+                self.start()
+        finally:
+            self.kill()
+
+    def status(self):
+        """Return the restart statistics."""
+
+        downtime = self.downtime
+        if self.down_since is not None:
+            downtime += time.monotonic() - self.down_since
+        return {
+            'restarts': self.restarts,
+            'downtime': round(downtime, 1),
+            'last_exit_code': self.last_exit_code,
+            'receiving': self.down_since is None,
+        }
@@ -0,0 +1,103 @@
+"""Parser for FLEX lines as produced by multimon-ng."""
+import re
+
+# Priority strings, checked in order so the most urgent one wins
+PRIORITY_PATTERNS = (
+    (1, re.compile(r"^A\s?1|\s?A\s?1|PRIO\s?1|^P\s?1", re.IGNORECASE)),
+    (2, re.compile(r"^A\s?2|\s?A\s?2|PRIO\s?2|^P\s?2", re.IGNORECASE)),
+    (3, re.compile(r"^B\s?1|^B\s?2|^B\s?3|PRIO\s?3|^P\s?3", re.IGNORECASE)),
+    (4, re.compile(r"^PRIO\s?4|^P\s?4", re.IGNORECASE)),
+)
+
+# Valid postalcode with the words around it
+# A2 (DIA: ja) AMBU 17106 Schiedamseweg 3134BA Vlaardingen VLAARD bon 8576
+# or with only postalcode number
+# A1 13108 Surinameplein 1058 Amsterdam 12006
+ADDRESS_RE = re.compile(r"(\w*.) ([1-9][0-9]{3})([A-Z]{2})? (.\w*)")
+# Cheap check for the part every address match contains, saves the backtracking of ADDRESS_RE
+POSTCODE_RE = re.compile(r" [1-9][0-9]{3}(?:[A-Z]{2})? ")
+
+# City right after a prio
+# A1 Breda
+PRIO_CITY_RE = re.compile(r"(^A\s?1|\s?A\s?2|B\s?1|^B\s?2|^B\s?3|PRIO\s?1|^P\s?1|PRIO\s?2|^P\s?2) (.\w*)")
+
+# Uppercase words with len 3 or longer, likely city abbreviations
+# A2 Ambulancepost Moordrecht Middelweg MOORDR V
+ABBREVIATION_RE = re.compile(r"[A-Z]{3,}")
+
+# All status info like prio, unit and ride numbers
+STATUS_RE = re.compile(
+    r"(^A\s?1|\s?A\s?2|B\s?1|^B\s?2|^B\s?3|PRIO\s?1|^P\s?1|PRIO\s?2|^P\s?2|^PRIO\s?3|^P\s?3|^PRIO\s?4|^P\s?4)(\W\d{2,}|.*(BR)\b|)"
+    r"|(rit:|rit|bon|bon:|ambu|dia)\W\d{5,8}|\b\d{5,}$|( : )|\(([^\)]+)\)( \b\d{5,}|)|directe (\w*)|(-)+/gi",
+    re.IGNORECASE
+)
+SPACES_RE = re.compile(r"(^[ \t]+|[ \t]+$)")
+
+# Final non-address symbols
+ADDRESS_CLEANUP_RE = re.compile(r"(- )|(\w[0-9] )")
+
+
+class FlexRecord:
+    """All fields extracted from a single FLEX line."""
+
+    __slots__ = (
+        'raw', 'timestamp', 'groupid', 'capcodes', 'body', 'priority',
+        'street', 'postalcode', 'city', 'address', 'prio_city', 'abbreviations',
+    )
+
+    def __init__(self, raw, timestamp, groupid, capcodes, body):
+        self.raw = raw
+        self.timestamp = timestamp
+        self.groupid = groupid
+        self.capcodes = capcodes
+        self.body = body
+        self.priority = 0
+        self.street = ""
+        self.postalcode = ""
+        self.city = ""
+        self.address = ""
+        self.prio_city = ""
+        self.abbreviations = ()
+
+    def stripped(self):
+        """Return the body without status info, used to guess a city name."""
+
+        return SPACES_RE.sub("", STATUS_RE.sub("", self.body).strip())
+
+
+def get_priority(message):
+    """Look for priority strings and return level."""
+
+    for priority, pattern in PRIORITY_PATTERNS:
+        if pattern.search(message):
+            return priority
+    return 0
+
+
+def parse_line(line):
+    """Parse a FLEX ALN line into a FlexRecord, return None if it isn't one."""
+
+    # FLEX|2024-03-09 14:02:14|1600/2/K/A|08.112|001720002 001720146|ALN|A2 ...
+    fields = line.split("|", 6)
+    if len(fields) < 7 or fields[0] != "FLEX" or fields[5] != "ALN":
+        return None
+
+    body = fields[6].strip()
+    record = FlexRecord(line.strip(), fields[1], fields[3].strip(), fields[4].split(), body)
+    record.priority = get_priority(body)
+
+    addr = ADDRESS_RE.search(body) if POSTCODE_RE.search(body) else None
+    if addr:
+        street, digits, letters, city = addr.groups()
+        record.street = street
+        # Add space between digits and letters of postalcode to get better OpenCage results
+        record.postalcode = f"{digits} {letters}" if letters else digits
+        record.city = city
+        record.address = f"{street} {record.postalcode} {city}"
+    else:
+        loc = PRIO_CITY_RE.search(body)
+        if loc:
+            record.prio_city = loc.group(2)
+        record.abbreviations = ABBREVIATION_RE.findall(body)
+
+    return record
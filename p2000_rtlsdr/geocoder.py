@@ -0,0 +1,475 @@
+"""Geocoding of addresses, using local caches in front of OpenCage."""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone, datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from caches import LRUCache, NegativeCache
+from utils import log_message
+
+OPENCAGE_URL = 'https://api.opencagedata.com/geocode/v1/json'
+
+
+class OpenCageGeocodeError(Exception):
+    """Base class for all errors/exceptions that can happen when geocoding."""
+
+
+class InvalidInputError(OpenCageGeocodeError):
+    """There was a problem with the input you provided."""
+
+    def __init__(self, bad_value):
+        super().__init__()
+        self.bad_value = bad_value
+
+    def __unicode__(self):
+        return "Input must be a unicode string, not "+repr(self.bad_value)[:100]
+
+    __str__ = __unicode__
+
+
+class UnknownError(OpenCageGeocodeError):
+    """There was a problem with the OpenCage server."""
+
+
+class RateLimitExceededError(OpenCageGeocodeError):
+    """
+    Exception raised when account has exceeded it's limit.
+
+    :var datetime reset_time: When your account limit will be reset.
+    :var int reset_to: What your account will be reset to.
+    """
+
+    def __init__(self, reset_time, reset_to):
+        """Constructor."""
+        super().__init__()
+        self.reset_time = reset_time
+        self.reset_to = reset_to
+
+    def __unicode__(self):
+        """Convert exception to a string."""
+        return ("Your rate limit has expired. "
+                f"It will reset to {self.reset_to} on {self.reset_time.isoformat()}"
+                )
+
+    __str__ = __unicode__
+
+
+class NotAuthorizedError(OpenCageGeocodeError):
+    """Exception raised when an unautorized API key is used."""
+
+    def __unicode__(self):
+        """Convert exception to a string."""
+        return "Your API key is not authorized. You may have entered it incorrectly."
+
+    __str__ = __unicode__
+
+
+class ForbiddenError(OpenCageGeocodeError):
+    """Exception raised when a blocked or suspended API key is used."""
+
+    def __unicode__(self):
+        """Convert exception to a string."""
+        return "Your API key has been blocked or suspended."
+
+    __str__ = __unicode__
+
+class OpenCageClient:
+    """OpenCage API client with a persistent connection, retries and rate limit tracking."""
+
+    def __init__(self, key, url=OPENCAGE_URL, timeout=5, retries=2, backoff=0.5, connections=2):
+        """Initialize the client."""
+
+        self.key = key
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        # Keep-alive connections, one per geocoder worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # From the rate block of the last response, free trial accounts only
+        self.rate_limit = None
+        self.rate_remaining = None
+        self.rate_reset = None
+        self.limited_until = 0
+
+    def rate_limited(self):
+        """Return True while the account has no requests left."""
+
+        return time.time() < self.limited_until
+
+    def update_rate(self, rate):
+        """Keep track of the rate block of a response."""
+
+        if not rate:
+            return
+        self.rate_limit = rate.get('limit', self.rate_limit)
+        self.rate_remaining = rate.get('remaining', self.rate_remaining)
+        self.rate_reset = rate.get('reset', self.rate_reset)
+        if self.rate_remaining == 0 and self.rate_reset:
+            self.limited_until = self.rate_reset
+
+    def retry_delay(self, attempt):
+        """Return the exponential backoff with jitter for a retry."""
+
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def geocode(self, query):
+        """Return the decoded OpenCage response for query."""
+
+        params = {'q': query, 'key': self.key, 'limit': 1, 'country': 'nl', 'language': 'nl'}
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(self.url, params=params, timeout=self.timeout)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as err:
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay(attempt))
+                    attempt += 1
+                    continue
+                raise UnknownError(f"{type(err).__name__} occurred while fetching data from OpenCage") from err
+            except requests.exceptions.RequestException as err:
+                # Not worth a retry, like a bad url or a broken response
+                raise UnknownError(f"{type(err).__name__}: '{err}' occurred while fetching data from OpenCage") from err
+
+            try:
+                response_json = response.json()
+            except ValueError:
+                response_json = None
+            if isinstance(response_json, dict):
+                self.update_rate(response_json.get('rate'))
+
+            if response.status_code >= 500 and attempt < self.retries:
+                time.sleep(self.retry_delay(attempt))
+                attempt += 1
+                continue
+
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as err:
+                if response.status_code == 401:
+                    raise NotAuthorizedError() from err
+
+                if response.status_code == 403:
+                    raise ForbiddenError() from err
+
+                if response.status_code in (402, 429):
+                    # Rate limit exceeded, without a reset time from the server try again in a minute
+                    if not self.rate_reset or self.rate_reset <= time.time():
+                        self.limited_until = time.time() + 60
+                    else:
+                        self.limited_until = self.rate_reset
+                    raise RateLimitExceededError(
+                        reset_to=self.rate_limit,
+                        reset_time=datetime.fromtimestamp(self.limited_until, tz=timezone.utc)
+                    ) from err
+
+                raise UnknownError(f"{response.status_code} status code from API") from err
+
+            if response_json is None:
+                raise UnknownError("Non-JSON result from server")
+
+            if 'results' not in response_json:
+                raise UnknownError("JSON from API doesn't have a 'results' key")
+
+            return response_json
+
+
+class PostcodeGeocoder:
+    """Find coordinates in the postcode and street centroid tables, without any network access."""
+
+    def __init__(self, database):
+        """Initialize the lookups."""
+
+        self.database = database
+        self.hits = 0
+        self.misses = 0
+        self.areas = 0
+
+    @staticmethod
+    def mapurl(latitude, longitude, zoom):
+        """Return an OpenStreetMap link like the ones OpenCage gives."""
+
+        return f"https://www.openstreetmap.org/?mlat={latitude}&mlon={longitude}#map={zoom}/{latitude}/{longitude}"
+
+    def geocode(self, postalcode, street, city):
+        """Return (latitude, longitude, mapurl) of a full postcode or a street in a city, None if unknown."""
+
+        postcode = postalcode.replace(" ", "")
+        if len(postcode) == 6:
+            row = self.database.find_postcode(postcode)
+            if row:
+                self.hits += 1
+                return (row["latitude"], row["longitude"], self.mapurl(row["latitude"], row["longitude"], 18))
+
+        if street and city:
+            row = self.database.find_street(street, city)
+            if row:
+                self.hits += 1
+                return (row["latitude"], row["longitude"], self.mapurl(row["latitude"], row["longitude"], 17))
+
+        self.misses += 1
+        return None
+
+    def geocode_area(self, postalcode):
+        """Return (latitude, longitude, mapurl) of the numbers of a postcode, None if unknown."""
+
+        if len(postalcode) < 4:
+            return None
+        row = self.database.find_postcode(postalcode[:4])
+        if row:
+            self.areas += 1
+            return (row["latitude"], row["longitude"], self.mapurl(row["latitude"], row["longitude"], 14))
+        return None
+
+    def stats(self):
+        """Return the counters."""
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'areas': self.areas,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class Geocoder:
+    """Find coordinates for an address.
+
+    The tiers are tried in order: an in-process LRU cache, the postcode and
+    street centroid tables, a negative cache of addresses OpenCage could not
+    resolve (persisted with an expiry), the geocodes table and finally OpenCage
+    itself. OpenCage is queried by a small pool of worker threads, so the caller
+    never waits for the network. When OpenCage is not asked, the centroid of
+    the postcode numbers is used if there is one.
+    """
+
+    def __init__(self, database, token, debug=False, failure_ttl=7 * 24 * 3600, workers=2, max_pending=20, url=OPENCAGE_URL, use_opencage=True):
+        """Initialize the geocoder and load the known failures."""
+
+        self.database = database
+        self.postcodes = PostcodeGeocoder(database)
+        self.client = OpenCageClient(token, url=url, connections=workers)
+        self.use_opencage = use_opencage
+        self.debug = debug
+        self.failure_ttl = failure_ttl
+
+        self.cache = LRUCache(maxsize=2000)
+        self.failures = NegativeCache(maxsize=20000)
+        now = time.time()
+        for query, expires in database.load_geocode_failures(now):
+            self.failures.put(query, True, ttl=expires - now)
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Geocoder")
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+        # Statistics of the tiers behind the caches
+        self.database_hits = 0
+        self.database_misses = 0
+        self.opencage_found = 0
+        self.opencage_failed = 0
+
+    def geocode(self, address, street, postalcode="", city=""):
+        """Return (latitude, longitude, mapurl) for an address, None if it is unknown.
+
+        When OpenCage has to be asked a Future is returned that gives one of these.
+        """
+
+        result = self.cache.get(address)
+        if result:
+            log_message(f"Address '{address}' was found in geocode cache", self.debug)
+            return result
+
+        result = self.postcodes.geocode(postalcode, street, city)
+        if result:
+            log_message(f"Address '{address}' was found in postcode tables: {result[0]}, {result[1]}", self.debug)
+            return result
+
+        if address in self.failures:
+            log_message(f"Address '{address}' could not be geocoded before, skipping", self.debug)
+            return self.postcodes.geocode_area(postalcode)
+
+        log_message(f"Checking gps database for '{address}'", self.debug)
+        geocode = self.database.find_geocode(address)
+        if geocode:
+            self.database_hits += 1
+            result = (geocode["latitude"], geocode["longitude"], geocode["mapurl"])
+            log_message(f"GPS database results: {result[0]}, {result[1]}, {result[2]}", self.debug)
+            self.cache.put(address, result)
+            return result
+        self.database_misses += 1
+
+        if not self.use_opencage or self.disabled:
+            return self.postcodes.geocode_area(postalcode)
+
+        with self.lock:
+            # The same address is often sent several times in a row
+            future = self.inflight.get(address)
+            if future is not None:
+                return future
+            if not self.pending.acquire(blocking=False):
+                log_message(f"Too many OpenCage queries pending, not geocoding '{address}'", True)
+                return self.postcodes.geocode_area(postalcode)
+            future = self.pool.submit(self.resolve, address, street, postalcode)
+            self.inflight[address] = future
+        future.add_done_callback(lambda _: self.done(address))
+        return future
+
+    @property
+    def disabled(self):
+        """Return True while OpenCage can't be used because of its rate limit."""
+
+        return self.client.rate_limited()
+
+    @property
+    def rate_remaining(self):
+        """Return the number of OpenCage requests left today, if known."""
+
+        remaining = self.client.rate_remaining
+        return 9999 if remaining is None else remaining
+
+    def resolve(self, address, street, postalcode):
+        """Worker thread, ask OpenCage and cache the result."""
+
+        try:
+            result = self.query_opencage(address, street)
+        except Exception as err:
+            # The message waits for this result, it has to be posted anyway
+            log_message(f"{type(err).__name__}: '{err}' occurred while geocoding '{address}'", True)
+            self.opencage_failed += 1
+            result = None
+        if result:
+            self.opencage_found += 1
+            self.cache.put(address, result)
+            return result
+        return self.postcodes.geocode_area(postalcode)
+
+    def busy(self):
+        """Return True while OpenCage queries are running or waiting for a worker."""
+
+        with self.lock:
+            return bool(self.inflight)
+
+    def done(self, address):
+        """Free the slot of a finished query."""
+
+        with self.lock:
+            self.inflight.pop(address, None)
+        self.pending.release()
+
+    def close(self):
+        """Wait for the pending queries and stop the workers."""
+
+        self.pool.shutdown(wait=True)
+
+    def query_opencage(self, address, street):
+        """Ask OpenCage for the address, remember it as a failure when it can't be resolved."""
+
+        locations = None
+        try:
+            log_message(f"OpenCage query: '{address}'", self.debug)
+            locations = self.client.geocode(address)
+            log_message(f"OpenCageGecode: {locations}", self.debug)
+            if int(locations['total_results']) > 0:
+
+                plaats = ""
+                postcode = ""
+                road = ""
+                oc_address = ""
+                components = locations['results'][0]['components']
+                datatype = components['_type']
+
+                # Plaats can be in city, town or village field
+                if 'city' in components:
+                    plaats = components['city']
+                if 'town' in components:
+                    plaats = components['town']
+                if 'village' in components:
+                    plaats = components['village']
+                if 'road' in components:
+                    road = components['road']
+                if 'postcode' in components:
+                    postcode = components['postcode']
+
+                if plaats and plaats in address or (plaats == 'Den Haag' and 's-Gravenhage' in address):
+                    latitude = locations['results'][0]['geometry']['lat']
+                    longitude = locations['results'][0]['geometry']['lng']
+                    mapurl = locations['results'][0]['annotations']['OSM']['url']
+
+                    # OpenCage returned a different postal code, keep the original but update rest of addresss
+                    if datatype == 'city':
+                        oc_address = f"{plaats}"
+                    elif postcode and road:
+                        oc_address = f"{road}, {postcode} {plaats}"
+
+                    log_message(
+                        f"OpenCage results: {datatype} {latitude}, {longitude}, '{oc_address}', '{mapurl}'", self.debug
+                    )
+
+                    try:
+                        self.database.store_geocode(address, datatype, str(longitude), str(latitude), postcode, street, plaats, oc_address, mapurl)
+                    except Exception:
+                        log_message(
+                            f"Error while trying to store geocode data in database: '{address}'", True
+                        )
+                    return (latitude, longitude, mapurl)
+
+                log_message(f"OpenCage API returned invalid location for given address (or returned wrong city for example): '{plaats}'", self.debug)
+                self.remember_failure(address, f"wrong city '{plaats}'")
+            else:
+                log_message(f"OpenCage API didn't return any location data for this address: '{address}'", self.debug)
+                self.remember_failure(address, "no results")
+
+        except (IndexError, KeyError) as err:
+            log_message(f"{type(err).__name__}: '{err}' occurred while parsing: '{locations}'", True)
+            self.opencage_failed += 1
+        except (RateLimitExceededError) as err:
+            # Rate limit reached, the client doesn't query OpenCage until it resets
+            log_message(err, True)
+        except (InvalidInputError, NotAuthorizedError, ForbiddenError, UnknownError) as err:
+            log_message(err, True)
+            self.opencage_failed += 1
+
+        return None
+
+    def remember_failure(self, query, reason):
+        """Don't ask OpenCage about this address again until the failure expires."""
+
+        self.opencage_failed += 1
+        self.failures.add(query, self.failure_ttl)
+        try:
+            self.database.store_geocode_failure(query, reason, time.time() + self.failure_ttl)
+        except Exception:
+            log_message(f"Error while trying to store geocode failure in database: '{query}'", True)
+
+    def stats(self):
+        """Return the hit rate of each tier."""
+
+        database_lookups = self.database_hits + self.database_misses
+        return {
+            'memory': self.cache.stats(),
+            'negative': self.failures.stats(),
+            'postcode': self.postcodes.stats(),
+            'database': {
+                'hits': self.database_hits,
+                'misses': self.database_misses,
+                'hit_rate': round(self.database_hits / database_lookups, 3) if database_lookups else 0.0,
+            },
+            'opencage': {
+                'found': self.opencage_found,
+                'failed': self.opencage_failed,
+                'rate_remaining': self.rate_remaining,
+            },
+        }
@@ -0,0 +1,182 @@
+"""Timing helpers and the Prometheus metrics endpoint for the P2000 message pipeline."""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import log_message
+
+# Upper bounds in seconds of the histogram buckets, from parsing a line (us) to waiting for OpenCage (s)
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class StageTimings:
+    """Accumulate the time spent in each stage of the pipeline."""
+
+    def __init__(self):
+        """Initialize the stage table."""
+
+        self.lock = threading.Lock()
+        # Stage name -> [count, total seconds, max seconds, bucket counts], in first-seen order
+        self.stages = {}
+
+    def record(self, stage, elapsed):
+        """Add one measurement for a stage."""
+
+        bucket = bisect.bisect_left(BUCKETS, elapsed)
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = [0, 0.0, elapsed, [0] * (len(BUCKETS) + 1)]
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+            entry[3][bucket] += 1
+
+    def stats(self, stage):
+        """Return (count, mean seconds, max seconds) of a stage."""
+
+        with self.lock:
+            count, total, maximum, _ = self.stages.get(stage, (0, 0.0, 0.0, None))
+        return count, total / count if count else 0.0, maximum
+
+    def histograms(self):
+        """Return stage name -> (count, total seconds, cumulative count per bucket of BUCKETS and +Inf)."""
+
+        histograms = {}
+        with self.lock:
+            for stage, (count, total, _, buckets) in self.stages.items():
+                cumulative = []
+                running = 0
+                for bucket in buckets:
+                    running += bucket
+                    cumulative.append(running)
+                histograms[stage] = (count, total, cumulative)
+        return histograms
+
+    def timer(self):
+        """Return a lap timer that records into this table."""
+
+        return LapTimer(self)
+
+    def report(self):
+        """Return a list of printable lines, one per stage."""
+
+        lines = []
+        with self.lock:
+            for stage, (count, total, maximum, _) in self.stages.items():
+                lines.append(
+                    f"{stage:<10} count: {count:>8}  total: {total * 1000:>10.1f} ms  "
+                    f"mean: {total / count * 1e6:>9.1f} us  max: {maximum * 1e6:>9.1f} us"
+                )
+        return lines
+
+
+class LapTimer:
+    """Measure consecutive stages, each lap records the time since the previous one."""
+
+    __slots__ = ('timings', 'last')
+
+    def __init__(self, timings):
+        self.timings = timings
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        """Record the time since the previous lap under stage."""
+
+        now = time.perf_counter()
+        self.timings.record(stage, now - self.last)
+        self.last = now
+
+
+def format_labels(labels):
+    """Return labels as {name="value",...}, or nothing without labels."""
+
+    if not labels:
+        return ""
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class PrometheusText:
+    """Build a scrape in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help, samples):
+        """Add a counter or gauge with (labels, value) samples."""
+
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{format_labels(labels)} {float(value)!r}")
+
+    def histogram(self, name, help, series):
+        """Add a histogram with (labels, (count, total, cumulative buckets)) series from StageTimings."""
+
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, (count, total, cumulative) in series:
+            for bound, running in zip(BUCKETS + ('+Inf',), cumulative):
+                self.lines.append(f"{name}_bucket{format_labels(dict(labels, le=bound))} {running}")
+            self.lines.append(f"{name}_sum{format_labels(labels)} {total!r}")
+            self.lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+    def text(self):
+        """Return the scrape."""
+
+        return "\n".join(self.lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answer GET /metrics with the text the server collects."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collect().encode()
+        except Exception as err:
+            log_message(f"Error while collecting metrics: {err}", True)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Don't log every scrape."""
+
+
+class MetricsServer:
+    """HTTP server for Prometheus scrapes, running in its own thread.
+
+    collect is called for every scrape and returns the text to serve.
+    """
+
+    def __init__(self, port, collect, host=''):
+        """Start listening on the port."""
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.collect = collect
+        self.thread = threading.Thread(name="MetricsThread", target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        log_message(f"Metrics available on port {port} at /metrics")
+
+    def close(self):
+        """Stop serving."""
+
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,374 @@
+"""Long-lived MQTT connection for all publishes of the add-on."""
+import ssl
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from metrics import StageTimings
+from spool import Spool
+from utils import log_message
+
+
+class MqttSender:
+    """MQTT sender class.
+
+    One paho client stays connected, its network loop runs in its own thread and
+    reconnects by itself. Publishes go with at least QoS 1, the client sends those
+    again after a reconnect, and max_inflight of them may wait for an
+    acknowledgement. Publishes made while the broker is away are spooled on disk,
+    up to max_queued of them, and sent at spool_rate per second after reconnecting.
+    A spooled publish stays on disk until the broker acknowledged it.
+    """
+
+    def __init__(self, mqtt_config, debug, dry_run=False, spool_path=None):
+        """Initialize class and start connecting in the background."""
+
+        log_message('Configured MQTT sender:')
+        self.d = {}
+        self.d['hostname'] = mqtt_config.get('host', 'localhost')
+        self.d['port'] = int(mqtt_config.get('port', 1883))
+        self.d['username'] = mqtt_config.get('user', None)
+        self.d['password'] = mqtt_config.get('password', None)
+        self.d['client_id'] = mqtt_config.get('client_id', 'p2000_rtlsdr')
+        self.d['base_topic'] = mqtt_config.get('base_topic', 'p2000_rtlsdr')
+        self.d['availability_topic'] = '{}/status'.format(self.d['base_topic'])
+        self.d['max_inflight'] = int(mqtt_config.get('max_inflight', 20))
+        self.d['max_queued'] = int(mqtt_config.get('max_queued', 10000))
+        self.d['spool_rate'] = max(int(mqtt_config.get('spool_rate', 50)), 1)
+        tls_enabled = mqtt_config.get('tls_enabled', False)
+        tls_ca = mqtt_config.get('tls_ca', '/etc/ssl/certs/ca-certificates.crt')
+        tls_cert = mqtt_config.get('tls_cert', None)
+        cert_reqs = ssl.CERT_NONE if mqtt_config.get('tls_insecure', True) else ssl.CERT_REQUIRED
+        tls_keyfile = mqtt_config.get('tls_keyfile', None)
+        self.d['tls'] = None
+        self.debug = debug
+        self.dry_run = dry_run
+
+        if tls_enabled:
+            self.d['tls'] = { 'ca_certs': tls_ca, 'certfile': tls_cert, 'keyfile': tls_keyfile, 'cert_reqs': cert_reqs }
+        self.__log_mqtt_params(**self.d)
+
+        # The lock guards the state below and is never held while calling the client, its
+        # callbacks take it from the loop thread. send_lock keeps the publishes in order.
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.send_lock = threading.Lock()
+        self.connected = False
+        self.closed = False
+        # True while there are publishes in the spool, new ones go behind them
+        self.spooled = False
+        # Topics to subscribe to again after every reconnect
+        self.subscriptions = set()
+        # Retained (topic, payload) messages sent after every connect, past the spool
+        self.announcements = []
+        # Index of the next announcement to send and the message ids of the ones in flight, at most
+        # half of max_inflight so the other publishes don't wait behind them
+        self.announce_next = 0
+        self.announcing = set()
+        # Message id -> time.monotonic() of the publish, until the broker has it
+        self.sent = {}
+        # Message id -> time.monotonic() of the acknowledgement, when it came in before publish() returned
+        self.early = {}
+        # Message id -> spool row, removed from the spool when the broker acknowledged it
+        self.rows = {}
+        # Newest spool row handed to the client, the drain thread continues after it
+        self.cursor = 0
+        self.timings = StageTimings()
+        self.published = 0
+        # Publishes the client did not accept, they were spooled
+        self.failed = 0
+        self.connects = 0
+        self.disconnects = 0
+
+        self.client = None
+        self.spool = None
+        if not dry_run:
+            self.spool = Spool(spool_path or ':memory:', self.d['max_queued'])
+            # The status of an earlier run is out of date, on_connect reports 'online'
+            self.spool.discard(self.d['availability_topic'])
+            self.spooled = len(self.spool) > 0
+            self.client = self.__create_client()
+            self.client.connect_async(self.d['hostname'], self.d['port'], keepalive=60)
+            self.client.loop_start()
+            self.drain_thread = threading.Thread(name="MqttSpoolThread", target=self.__drain, daemon=True)
+            self.drain_thread.start()
+
+    def __create_client(self):
+        """Return a configured paho client."""
+
+        # paho-mqtt 2 wants to know which callback signatures we use
+        if hasattr(mqtt, 'CallbackAPIVersion'):
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=self.d['client_id'])
+        else:
+            client = mqtt.Client(client_id=self.d['client_id'])
+        if self.d['username'] and self.d['password']:
+            client.username_pw_set(self.d['username'], self.d['password'])
+        if self.d['tls']:
+            client.tls_set(**self.d['tls'])
+        client.will_set(self.d['availability_topic'], payload='offline', qos=1, retain=True)
+        client.max_inflight_messages_set(self.d['max_inflight'])
+        # A second of spool draining on top of the messages in flight, publishes beyond that are spooled
+        client.max_queued_messages_set(self.d['max_inflight'] + self.d['spool_rate'])
+        client.reconnect_delay_set(min_delay=1, max_delay=60)
+        client.on_connect = self.__on_connect
+        client.on_disconnect = self.__on_disconnect
+        client.on_publish = self.__on_publish
+        return client
+
+    def __on_connect(self, client, userdata, flags, rc):
+        """Announce ourselves and let the drain thread send the announcements and the spool."""
+
+        if rc != 0:
+            log_message('MQTT broker refused the connection: {}'.format(mqtt.connack_string(rc)), True)
+            return
+        log_message('Connected to MQTT broker {}:{}'.format(self.d['hostname'], self.d['port']), self.debug or self.connects == 0)
+        with self.send_lock:
+            with self.lock:
+                self.connected = True
+                self.connects += 1
+            # The broker may have published our will while we were away
+            self.__send(self.d['availability_topic'], 'online', 1, True)
+            with self.lock:
+                self.announce_next = 0
+                self.announcing.clear()
+        with self.lock:
+            topics = list(self.subscriptions)
+        for topic in topics:
+            client.subscribe(topic, qos=1)
+        with self.condition:
+            self.condition.notify_all()
+
+    def __on_disconnect(self, client, userdata, rc):
+        """Spool publishes until the loop thread has reconnected."""
+
+        with self.lock:
+            self.connected = False
+            # The client sends the unacknowledged publishes again, without a latency
+            self.sent.clear()
+            self.early.clear()
+            if rc != 0:
+                self.disconnects += 1
+        if rc != 0:
+            log_message('Lost connection to MQTT broker ({}), reconnecting'.format(mqtt.error_string(rc)), True)
+
+    def __on_publish(self, client, userdata, mid):
+        """Record the publish latency until the broker acknowledged it, and drop it from the spool."""
+
+        now = time.monotonic()
+        with self.lock:
+            sent = self.sent.pop(mid, None)
+            row = self.rows.pop(mid, None)
+            if sent is None and row is None:
+                self.early[mid] = now
+            if mid in self.announcing:
+                self.announcing.discard(mid)
+                self.condition.notify_all()
+        if sent is not None:
+            self.timings.record('publish', now - sent)
+        if row is not None:
+            self.spool.remove([row])
+
+    def __send(self, topic, payload, qos, retain, row=None, announcement=False):
+        """Hand a message to the client, send_lock has to be held. Return False when it was not accepted.
+
+        The client keeps a QoS 1 publish until the broker has it, also while it is not connected.
+        """
+
+        started = time.monotonic()
+        info = self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not (qos and info.rc == mqtt.MQTT_ERR_NO_CONN):
+            with self.lock:
+                self.failed += 1
+            return False
+        with self.lock:
+            self.published += 1
+            acknowledged = self.early.pop(info.mid, None)
+            if acknowledged is None:
+                self.sent[info.mid] = started
+                if row is not None:
+                    self.rows[info.mid] = row
+                if announcement:
+                    self.announcing.add(info.mid)
+        if acknowledged is not None:
+            self.timings.record('publish', acknowledged - started)
+            if row is not None:
+                self.spool.remove([row])
+        return True
+
+    def __announce_room(self):
+        """Return how many announcements can be sent now, the lock has to be held."""
+
+        if not self.connected:
+            return 0
+        room = max(self.d['max_inflight'] // 2, 1) - len(self.announcing)
+        return max(min(room, len(self.announcements) - self.announce_next), 0)
+
+    def __announce(self):
+        """Hand the announcements there is room for to the client, send_lock has to be held.
+
+        Return False when the client did not accept one.
+        """
+
+        with self.lock:
+            start = self.announce_next
+            announcements = self.announcements[start:start + self.__announce_room()]
+        accepted = True
+        for topic, payload in announcements:
+            accepted = self.__send(topic, payload, 1, True, announcement=True)
+            if not accepted:
+                break
+            start += 1
+        with self.lock:
+            self.announce_next = start
+        return accepted
+
+    def __spool(self, message):
+        """Keep a message on disk until the broker has room for it, send_lock has to be held."""
+
+        self.spool.put(*message)
+        with self.condition:
+            self.spooled = True
+            self.condition.notify_all()
+
+    def __drain(self):
+        """Send the announcements, and the spooled publishes in batches of spool_rate per second while connected.
+
+        Each spooled publish stays in the spool until the broker acknowledged it, so one
+        that is in flight when the add-on stops is sent again after the next start.
+        """
+
+        next_batch = 0
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
+                    announce = self.__announce_room() > 0
+                    timeout = next_batch - time.monotonic() if self.connected and self.spooled else None
+                    if announce or (timeout is not None and timeout <= 0):
+                        break
+                    self.condition.wait(timeout)
+            if announce:
+                with self.send_lock:
+                    accepted = self.__announce()
+                if not accepted:
+                    # The client is full, give the broker time to acknowledge some
+                    with self.condition:
+                        self.condition.wait_for(lambda: self.closed, timeout=1)
+            if timeout is None or timeout > 0:
+                continue
+            next_batch = time.monotonic() + 1
+            sent = 0
+            with self.send_lock:
+                for id, topic, payload, qos, retain in self.spool.peek(self.d['spool_rate'], after=self.cursor):
+                    if not self.__send(topic, payload, max(qos, 1), bool(retain), row=id):
+                        break
+                    self.cursor = id
+                    sent += 1
+                left = bool(self.spool.peek(1, after=self.cursor))
+                with self.lock:
+                    self.spooled = left
+            if sent:
+                log_message('Sent {} spooled MQTT messages, {} left'.format(sent, len(self.spool)), self.debug or not left)
+
+    def publish(self, **kwargs):
+        """Publish MQTT data, or spool it when the broker is not connected."""
+
+        if self.debug:
+            log_message('Sending message to MQTT:')
+            self.__log_mqtt_params(**kwargs)
+        if self.dry_run:
+            return True
+        # A QoS 0 publish is lost when the connection drops before it was written
+        message = (kwargs.get('topic'), kwargs.get('payload', None), max(int(kwargs.get('qos', 0)), 1), kwargs.get('retain', False))
+        with self.send_lock:
+            with self.lock:
+                direct = self.connected and not self.spooled
+            if not direct or not self.__send(*message):
+                self.__spool(message)
+        return True
+
+    def announce(self, messages):
+        """Publish retained (topic, payload) messages now, and again after every reconnect.
+
+        The drain thread sends them past the spool, a few at a time, so the other
+        publishes neither wait for the spool nor for all of them.
+        """
+
+        if self.dry_run:
+            return
+        messages = list(messages)
+        with self.send_lock, self.condition:
+            self.announcements = messages
+            self.announce_next = 0
+            self.condition.notify_all()
+
+    def subscribe(self, topic, callback):
+        """Call callback with the paho message for every message on topic, from the network loop thread."""
+
+        if self.dry_run:
+            return
+        log_message('Subscribing to MQTT topic {}'.format(topic), self.debug)
+        self.client.message_callback_add(topic, lambda client, userdata, message: callback(message))
+        with self.lock:
+            self.subscriptions.add(topic)
+            connected = self.connected
+        if connected:
+            self.client.subscribe(topic, qos=1)
+
+    def stats(self):
+        """Return the publish counters and latency."""
+
+        count, mean, maximum = self.timings.stats('publish')
+        spool = self.spool
+        queued, age, dropped, coalesced = (len(spool), spool.age(), spool.dropped, spool.coalesced) if spool is not None else (0, 0.0, 0, 0)
+        with self.lock:
+            return {
+                'connected': self.connected,
+                'published': self.published,
+                'failed': self.failed,
+                'acknowledged': count,
+                'queued': queued,
+                'queued_age': age,
+                'dropped': dropped,
+                'coalesced': coalesced,
+                'reconnects': max(self.connects - 1, 0),
+                'disconnects': self.disconnects,
+                'latency_mean': mean,
+                'latency_max': maximum,
+            }
+
+    def close(self, timeout=5):
+        """Report 'offline', wait until the outstanding publishes are done and disconnect.
+
+        What is still spooled stays on disk and is sent after the next start.
+        """
+
+        if self.client is None:
+            return
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.drain_thread.join()
+        with self.send_lock:
+            with self.lock:
+                connected = self.connected
+            # Past the spool, a clean disconnect doesn't make the broker publish our will
+            if connected:
+                self.__send(self.d['availability_topic'], 'offline', 1, True)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.connected or not self.sent:
+                    break
+            time.sleep(0.05)
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.spool.close()
+
+    def __log_mqtt_params(self, **kwargs):
+        """Log MQTT data."""
+
+        for k, v in ((k, v) for (k, v) in kwargs.items() if k not in ['password']):
+            log_message(' > {} => {}'.format(k, v))
@@ -3,122 +3,266 @@ import os
 import sys
 import re
 import json
+import argparse
 import signal
-import subprocess
-import ssl
 import calendar
-import fnmatch
+import math
 import threading
-from datetime import timezone, datetime
+from concurrent.futures import Future
 from json.decoder import JSONDecodeError
 import time
 from fcntl import ioctl
 from stat import S_ISCHR
 import requests
 import usb.core
-import paho.mqtt.publish as publish
-from geopy.distance import geodesic
-from paho.mqtt import MQTTException
 import sqlite3
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from caches import LRUCache, NegativeCache
+from capcodes import CapcodeIndex
+from decoder import DecoderProcess
+from flexparser import ADDRESS_CLEANUP_RE, parse_line
+from geocoder import OPENCAGE_URL, Geocoder
+from places import PlaceIndex
+from metrics import MetricsServer, PrometheusText, StageTimings
+from mqttsender import MqttSender
+from scheduler import DeadlineScheduler, ReplayClock
+from sensors import SensorIndex, SensorMatcher, compile_patterns
+from utils import log_message
+from zones import CircleZones, PolygonZones, load_geojson
 
 
 class Database:
     """Contains all the database stuff."""
 
-    def __init__(self):
+    def __init__(self, dbpath="/data/geocodes.sqlite3", reference="/p2000.sqlite3", flush_rows=25, flush_interval=60):
         """Initialize database."""
 
-        self.db = self.open_database()
+        self.lock = threading.RLock()
+        # New geocodes and failures are written in batches, one commit per flush
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.pending_writes = []
+        self.pending_geocodes = {}
+        self.pending_since = None
+        self.flushes = 0
+        self.db = self.open_database(dbpath, reference)
         if not self.db:
             log_message('Cannot open the database, exiting.')
             # Stop the add-on
             sys.exit(1)
         self.cursor = self.db.cursor()
-        
-    def open_database(self):
-        """Open the database."""
 
-        dbpath = f"/data/p2000.sqlite3"
-
-        if not os.path.exists(dbpath):
-            log_message(f"Installing the database '{dbpath}'")
-            proc = subprocess.Popen('cp /p2000.sqlite3 /data/p2000.sqlite3', shell=True, stdin=None, stdout=None, stderr=None, executable="/bin/bash")
-            proc.wait()
+    def open_database(self, dbpath, reference):
+        """Load the reference data in memory and attach the geocode database."""
 
         try:
-            dbconnection = sqlite3.connect(f"file:{dbpath}?mode=rw", uri=True)
+            # The reference data is only read, with a copy in memory lookups never touch the SD card
+            # The geocoder workers store their results from other threads, all access is done holding self.lock
+            dbconnection = sqlite3.connect(":memory:", check_same_thread=False)
+            source = sqlite3.connect(f"file:{reference}?immutable=1", uri=True)
+            try:
+                source.backup(dbconnection)
+            finally:
+                source.close()
             dbconnection.row_factory = sqlite3.Row
+            log_message(f"Reference data '{reference}' loaded in memory")
+
+            # Geocodes are kept in their own database, so an update of the reference data doesn't lose them
+            new = not os.path.exists(dbpath)
+            dbconnection.execute("ATTACH DATABASE ? AS store", (dbpath,))
             log_message(f"Database '{dbpath}' opened successfully")
+            self.create_schema(dbconnection)
+            if new:
+                self.migrate_geocodes(dbconnection, os.path.join(os.path.dirname(dbpath), "p2000.sqlite3"), reference)
 
-        except sqlite3.OperationalError:
-            log_message(f"Error while trying to open database '{dbpath}'")
+        except sqlite3.Error as err:
+            log_message(f"Error while trying to open database '{dbpath}' with reference data '{reference}': {err}")
             return False
 
         return dbconnection
 
-    def database_stats(self):
-        """Display some database statistics."""
+    def create_schema(self, dbconnection):
+        """Create the missing tables and indexes and set up the connection."""
 
-        info = "Containing:"
-        for tablename in ['places','capcodes', 'geocodes']:
-            cnt = self.cursor.execute(f"SELECT count() FROM '{tablename}'").fetchone()[0]
-            info += f" {cnt} {tablename}"
-        log_message(info)
+        # Readers don't block the geocoder workers writing, and commits don't wait for a sync
+        dbconnection.execute("PRAGMA store.journal_mode = WAL")
+        dbconnection.execute("PRAGMA store.synchronous = NORMAL")
+        dbconnection.execute("PRAGMA temp_store = MEMORY")
+        dbconnection.execute("PRAGMA busy_timeout = 5000")
 
-    def check_plaatsnaam(self, plaatsnaam):
-        """Return True if plaatsnaam is in table."""
+        dbconnection.execute(
+            "CREATE TABLE IF NOT EXISTS store.geocodes (query TEXT, datatype TEXT, longitude TEXT, latitude TEXT, postalcode TEXT, street TEXT, city TEXT, address TEXT, mapurl TEXT)"
+        )
+        dbconnection.execute("CREATE TABLE IF NOT EXISTS store.geocode_failures (query TEXT PRIMARY KEY, reason TEXT, expires REAL)")
+        dbconnection.execute("CREATE INDEX IF NOT EXISTS store.geocodes_query ON geocodes (query)")
 
-        query = f"SELECT EXISTS(SELECT 1 FROM places WHERE city = '{plaatsnaam}')"
+        # Centroids of postcodes (PC6 and PC4) and streets, empty when the reference data has none
+        dbconnection.execute("CREATE TABLE IF NOT EXISTS main.postcodes (postcode TEXT PRIMARY KEY, city TEXT, latitude REAL, longitude REAL) WITHOUT ROWID")
+        dbconnection.execute("CREATE TABLE IF NOT EXISTS main.streets (city TEXT, street TEXT, latitude REAL, longitude REAL, PRIMARY KEY (city, street)) WITHOUT ROWID")
+        dbconnection.commit()
 
-        return self.cursor.execute(query).fetchone()[0]
+        # Let SQLite gather statistics for the new indexes
+        dbconnection.execute("PRAGMA optimize")
 
-    def find_plaatsnaam(self, abbreviation):
-        """Return full location name for abbreviated one."""
+    def migrate_geocodes(self, dbconnection, legacy, reference):
+        """Copy the geocodes from the database that used to hold everything."""
 
-        query = f"SELECT city FROM places WHERE abbreviation = '{abbreviation}'"
+        if not os.path.exists(legacy) or os.path.realpath(legacy) == os.path.realpath(reference):
+            return
 
-        return self.cursor.execute(query).fetchone()[0]
+        dbconnection.execute("ATTACH DATABASE ? AS legacy", (f"file:{legacy}?mode=ro",))
+        try:
+            tables = {row[0] for row in dbconnection.execute("SELECT name FROM legacy.sqlite_master WHERE type = 'table'")}
+            if 'geocodes' in tables:
+                dbconnection.execute("INSERT INTO store.geocodes SELECT * FROM legacy.geocodes")
+            if 'geocode_failures' in tables:
+                dbconnection.execute("INSERT OR IGNORE INTO store.geocode_failures SELECT * FROM legacy.geocode_failures")
+            dbconnection.commit()
+            count = dbconnection.execute("SELECT count() FROM store.geocodes").fetchone()[0]
+            log_message(f"Moved {count} geocodes from '{legacy}'")
+        finally:
+            dbconnection.execute("DETACH DATABASE legacy")
 
-    def check_pltsnm(self, pltsnm):
-        """Return True if pltsnm is in table."""
+    def database_stats(self):
+        """Display some database statistics."""
 
-        query = f"SELECT EXISTS(SELECT 1 FROM places WHERE abbreviation = '{pltsnm}')"
+        info = "Containing:"
+        for tablename in ['places', 'capcodes', 'postcodes', 'streets', 'store.geocodes']:
+            # Table names can't be parameters, these come from the fixed list above
+            cnt = self.cursor.execute(f'SELECT count() FROM {tablename}').fetchone()[0]
+            info += f" {cnt} {tablename.split('.')[-1]}"
+        log_message(info)
 
-        return self.cursor.execute(query).fetchone()[0]
+    def load_places(self):
+        """Return all (city, abbreviation) pairs."""
 
-    def find_capcode(self, capcode):
-        """Return all info we have for a capcode."""
+        return self.cursor.execute("SELECT city, abbreviation FROM places").fetchall()
 
-        query = f"SELECT discipline, region, location, description, remark FROM capcodes WHERE capcode = '{capcode}'"
+    def load_capcodes(self):
+        """Return all capcode rows."""
 
-        return self.cursor.execute(query).fetchone()
+        return self.cursor.execute("SELECT capcode, discipline, region, location, description, remark FROM capcodes")
+
+    def drop_loaded_tables(self):
+        """Free the places and capcodes of the in-memory copy, they are only looked up in their indexes."""
+
+        self.db.execute("DROP TABLE IF EXISTS main.places")
+        self.db.execute("DROP TABLE IF EXISTS main.capcodes")
+        self.db.commit()
+        # Dropped pages of an in-memory database are only given back by a vacuum
+        self.db.execute("VACUUM main")
 
     def find_geocode(self, address):
         """Return all info we have for an address."""
 
-        return self.cursor.execute(f"SELECT latitude, longitude, address, mapurl FROM geocodes WHERE query = '{address}'").fetchone()
+        # Addresses used to be stored without quotes
+        with self.lock:
+            geocode = self.pending_geocodes.get(address)
+            if geocode:
+                return geocode
+            return self.cursor.execute(
+                "SELECT latitude, longitude, address, mapurl FROM store.geocodes WHERE query IN (?, ?)", (address, address.replace("'", ""))
+            ).fetchone()
+
+    def find_postcode(self, postcode):
+        """Return the centroid of a postcode."""
+
+        with self.lock:
+            return self.cursor.execute("SELECT city, latitude, longitude FROM postcodes WHERE postcode = ?", (postcode,)).fetchone()
+
+    def find_street(self, street, city):
+        """Return the centroid of a street in a city."""
+
+        with self.lock:
+            return self.cursor.execute("SELECT latitude, longitude FROM streets WHERE city = ? AND street = ?", (city, street)).fetchone()
 
     def store_geocode(self, query, datatype, longitude, latitude, postalcode, street, city, address, mapurl):
         """Save all info we have for an address."""
 
         values = (query, datatype, longitude, latitude, postalcode, street, city, address, mapurl)
-        query = "INSERT INTO geocodes VALUES (?,?,?,?,?,?,?,?,?)"
 
-        self.cursor.execute(query, values)
+        with self.lock:
+            # Readers see the geocode right away, it is written with the next flush
+            self.pending_geocodes[query] = {'latitude': latitude, 'longitude': longitude, 'address': address, 'mapurl': mapurl}
+            self.queue_write("INSERT INTO store.geocodes VALUES (?,?,?,?,?,?,?,?,?)", values)
+
+    def load_geocode_failures(self, now):
+        """Return (query, expires) of all addresses that could not be geocoded and are not expired yet."""
+
+        self.cursor.execute("DELETE FROM store.geocode_failures WHERE expires <= ?", (now,))
         self.db.commit()
+        return self.cursor.execute("SELECT query, expires FROM store.geocode_failures").fetchall()
+
+    def store_geocode_failure(self, query, reason, expires):
+        """Save an address that could not be geocoded."""
+
+        self.queue_write("INSERT OR REPLACE INTO store.geocode_failures VALUES (?,?,?)", (query, reason, expires))
+
+    def queue_write(self, statement, values):
+        """Add a write to the next flush, flush when enough writes are waiting."""
+
+        with self.lock:
+            if not self.pending_writes:
+                self.pending_since = time.monotonic()
+            self.pending_writes.append((statement, values))
+            if len(self.pending_writes) >= self.flush_rows:
+                self.flush()
+
+    def flush_if_due(self):
+        """Flush the waiting writes when the oldest one has waited long enough."""
+
+        with self.lock:
+            if self.pending_writes and time.monotonic() - self.pending_since >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """Write all waiting writes in one transaction."""
+
+        with self.lock:
+            if not self.pending_writes:
+                return
+            try:
+                with self.db:
+                    for statement, values in self.pending_writes:
+                        self.cursor.execute(statement, values)
+                self.flushes += 1
+                log_message(f"Database: {len(self.pending_writes)} writes flushed")
+            except sqlite3.Error as err:
+                log_message(f"Error while trying to write {len(self.pending_writes)} rows to the database: {err}", True)
+            self.pending_writes.clear()
+            self.pending_geocodes.clear()
+
+    def close(self):
+        """Flush the waiting writes and close the database."""
+
+        with self.lock:
+            self.flush()
+            self.db.execute("PRAGMA optimize")
+            self.db.close()
 
 
 class MessageItem:
     """Contains all the Message data."""
 
+    # Many messages are in flight at once, slots keep them small, and so do the shared
+    # empty tuples instead of lists that are replaced by handle_line or post_data anyway
+    __slots__ = (
+        'message_raw', 'timestamp', 'timereceived', 'groupid', 'receivers', 'capcodes', 'body',
+        'location', 'postalcode', 'city', 'address', 'street', 'region', 'priority', 'disciplines',
+        'remarks', 'longitude', 'latitude', 'opencage', 'mapurl', 'distances', 'tts',
+        'geocode_future', 'posted_sensors', 'is_posted',
+    )
+
     def __init__(self):
-        self.timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.message_raw = ""
         self.timestamp = ""
         self.timereceived = time.monotonic()
         self.groupid = ""
         self.receivers = ""
-        self.capcodes = []
+        self.capcodes = ()
         self.body = ""
         self.location = ""
         self.postalcode = ""
@@ -127,146 +271,20 @@ class MessageItem:
         self.street = ""
         self.region = ""
         self.priority = 0
-        self.disciplines = ""
+        # The disciplines of all capcodes, each one once
+        self.disciplines = ()
         self.remarks = ""
         self.longitude = ""
         self.latitude = ""
         self.opencage = ""
         self.mapurl = ""
-        self.distance = ""
+        # Distance in km to the zone sensors near the location, per sensor id,
+        # set by post_data once the location is known
+        self.distances = None
         self.tts = ""
-
-
-class OpenCageGeocodeError(Exception):
-    """Base class for all errors/exceptions that can happen when geocoding."""
-
-
-class InvalidInputError(OpenCageGeocodeError):
-    """There was a problem with the input you provided."""
-
-    def __init__(self, bad_value):
-        super().__init__()
-        self.bad_value = bad_value
-
-    def __unicode__(self):
-        return "Input must be a unicode string, not "+repr(self.bad_value)[:100]
-
-    __str__ = __unicode__
-
-
-class UnknownError(OpenCageGeocodeError):
-    """There was a problem with the OpenCage server."""
-
-
-class RateLimitExceededError(OpenCageGeocodeError):
-    """
-    Exception raised when account has exceeded it's limit.
-
-    :var datetime reset_time: When your account limit will be reset.
-    :var int reset_to: What your account will be reset to.
-    """
-
-    def __init__(self, reset_time, reset_to):
-        """Constructor."""
-        super().__init__()
-        self.reset_time = reset_time
-        self.reset_to = reset_to
-
-    def __unicode__(self):
-        """Convert exception to a string."""
-        return ("Your rate limit has expired. "
-                f"It will reset to {self.reset_to} on {self.reset_time.isoformat()}"
-                )
-
-    __str__ = __unicode__
-
-
-class NotAuthorizedError(OpenCageGeocodeError):
-    """Exception raised when an unautorized API key is used."""
-
-    def __unicode__(self):
-        """Convert exception to a string."""
-        return "Your API key is not authorized. You may have entered it incorrectly."
-
-    __str__ = __unicode__
-
-
-class ForbiddenError(OpenCageGeocodeError):
-    """Exception raised when a blocked or suspended API key is used."""
-
-    def __unicode__(self):
-        """Convert exception to a string."""
-        return "Your API key has been blocked or suspended."
-
-    __str__ = __unicode__
-
-def OpenCageGeocode(query, key):
-
-        params =  { 'q': query, 'key': key, 'limit': 1, 'country': 'nl', 'language': 'nl' }
-        response_json = {}
-
-        try:
-            response = requests.get('https://api.opencagedata.com/geocode/v1/json', params=params, timeout=5)
-            response_json = response.json()
-        except requests.exceptions.Timeout:
-            log_message("Timeout occurred while fetching data from OpenCage")
-        except requests.exceptions.ConnectionError:
-            log_message("Connection error occurred while fetching data from OpenCage")
-        except requests.exceptions.HTTPError:
-            if response.status_code == 401:
-                raise NotAuthorizedError()
-    
-            if response.status_code == 403:
-                raise ForbiddenError()
-    
-            if response.status_code in (402, 429):
-                # Rate limit exceeded
-                reset_time = datetime.fromtimestamp(response.json()['rate']['reset'], tz=timezone.utc)
-                raise RateLimitExceededError(
-                    reset_to=int(response.json()['rate']['limit']),
-                    reset_time=reset_time
-                )
-    
-            if response.status_code == 500:
-                raise UnknownError("500 status code from API")
-
-        except ValueError as excinfo:
-            raise UnknownError("Non-JSON result from server") from excinfo
-
-        if 'results' not in response_json:
-            raise UnknownError("JSON from API doesn't have a 'results' key")
-
-        return response_json
-
-
-def check_filter(mylist, text):
-    """Check filter data."""
-
-    # If list is not loaded or empty allow all
-    if len(mylist) == 0:
-        return True
-
-    # Check if text applied matches at least one filter
-    for f_str in mylist:
-        if fnmatch.fnmatch(text, f_str):
-            return True
-
-    return False
-
-
-def check_filter_with_list(searchlist, list_to_be_searched):
-    """Check filter data with list."""
-
-    # If list is not loaded or empty allow all
-    if len(searchlist) == 0:
-        return True
-
-    # Check every text in the searchedlist
-    for searchedtext in list_to_be_searched:
-        if check_filter(searchlist, searchedtext) == True:
-            return True
-
-    return False
+        self.geocode_future = None
+        self.posted_sensors = ()
+        self.is_posted = False
 
 
 def to_local_datetime(utc_dt):
@@ -276,27 +294,6 @@ def to_local_datetime(utc_dt):
     return time.ctime(calendar.timegm(time_tuple))
 
 
-def p2000_get_prio(message):
-    """Look for priority strings and return level."""
-
-    priority = 0
-    regex_prio1 = r"^A\s?1|\s?A\s?1|PRIO\s?1|^P\s?1"
-    regex_prio2 = r"^A\s?2|\s?A\s?2|PRIO\s?2|^P\s?2"
-    regex_prio3 = r"^B\s?1|^B\s?2|^B\s?3|PRIO\s?3|^P\s?3"
-    regex_prio4 = r"^PRIO\s?4|^P\s?4"
-
-    if re.search(regex_prio1, message, re.IGNORECASE):
-        priority = 1
-    elif re.search(regex_prio2, message, re.IGNORECASE):
-        priority = 2
-    elif re.search(regex_prio3, message, re.IGNORECASE):
-        priority = 3
-    elif re.search(regex_prio4, message, re.IGNORECASE):
-        priority = 4
-
-    return priority
-
-
 def reset_usb_device(usbdev):
     """Reset USB device."""
 
@@ -344,80 +341,6 @@ def find_rtl_sdr_devices():
     return devices_found
 
 
-def log_message(message, log=True):
-    """Function to log messages to STDERR."""
-
-    if log == True:
-        now = datetime.now()
-        dt_string = now.strftime("%Y-%m-%d %H:%M:%S")
-        print(f'{dt_string}: {message}', file=sys.stderr)
-
-
-class MqttSender:
-    """MQTT sender class."""
-
-    def __init__(self, mqtt_config, debug):
-        """Initialize class."""
-
-        log_message('Configured MQTT sender:')
-        self.d = {}
-        self.d['hostname'] = mqtt_config.get('host', 'localhost')
-        self.d['port'] = int(mqtt_config.get('port', 1883))
-        self.d['username'] = mqtt_config.get('user', None)
-        self.d['password'] = mqtt_config.get('password', None)
-        self.d['client_id'] = mqtt_config.get('client_id', 'p2000_rtlsdr')
-        self.d['base_topic'] = mqtt_config.get('base_topic', 'p2000_rtlsdr')
-        self.d['availability_topic'] = '{}/status'.format(self.d['base_topic'])
-        tls_enabled = mqtt_config.get('tls_enabled', False)
-        tls_ca = mqtt_config.get('tls_ca', '/etc/ssl/certs/ca-certificates.crt')
-        tls_cert = mqtt_config.get('tls_cert', None)
-        cert_reqs = ssl.CERT_NONE if mqtt_config.get('tls_insecure', True) else ssl.CERT_REQUIRED
-        tls_keyfile = mqtt_config.get('tls_keyfile', None)
-        self.d['tls'] = None
-        self.debug = debug
-
-        if tls_enabled:
-            self.d['tls'] = { 'ca_certs': tls_ca, 'certfile': tls_cert, 'keyfile': tls_keyfile, 'cert_reqs': cert_reqs }
-        self.__log_mqtt_params(**self.d)
-
-    def __get_auth(self):
-        """Handle auth config."""
-
-        if self.d['username'] and self.d['password']:
-            return { 'username':self.d['username'], 'password': self.d['password'] }
-        return None
-
-    def publish(self, **kwargs):
-        """Publish MQTT data."""
-
-        if self.debug:
-            log_message('Sending message to MQTT:')
-            self.__log_mqtt_params(**kwargs)
-        topic = kwargs.get('topic')
-        payload = kwargs.get('payload', None)
-        qos = int(kwargs.get('qos', 0))
-        retain = kwargs.get('retain', False)
-        will = { 'topic': self.d['availability_topic'], 'payload': 'offline', 'qos': 1, 'retain': True }
-        try:
-            publish.single(
-                topic=topic, payload=payload, qos=qos, retain=retain, hostname=self.d['hostname'], port=self.d['port'],
-                client_id=self.d['client_id'], keepalive=60, will=will, auth=self.__get_auth(), tls=self.d['tls']
-            )
-        except MQTTException as e:
-            log_message('MQTTException connecting to MQTT broker: {}'.format(e), True)
-            return False
-        except Exception as e:
-            log_message('Unknown exception connecting to MQTT broker: {}'.format(e), True)
-            return False
-        return True
-
-    def __log_mqtt_params(self, **kwargs):
-        """Log MQTT data."""
-
-        for k, v in ((k, v) for (k, v) in kwargs.items() if k not in ['password']):
-            log_message(' > {} => {}'.format(k, v))
-
-
 def shutdown(signum, frame):
     """Use signal to shutdown and hard kill opened processes and self."""
 
@@ -432,11 +355,11 @@ def shutdown(signum, frame):
         sys.exit(0)
 
 
-def load_config():
+def load_config(config_file='/data/options.json'):
     """Load config from options file."""
 
     # Load config from options file
-    config = json.load(open(os.path.join('/data/options.json')))
+    config = json.load(open(config_file))
 
     # Add sensors to config
     if len(config['p2000_sensors']) < 1:
@@ -468,51 +391,114 @@ def load_config():
 
     return config
 
-# Create signal handlers/call back
-signal.signal(signal.SIGTERM, shutdown)
-signal.signal(signal.SIGINT, shutdown)
+
+def parse_arguments():
+    """Parse command line arguments."""
+
+    parser = argparse.ArgumentParser(description='Receive P2000 messages with an RTL-SDR dongle and publish them to MQTT.')
+    parser.add_argument('--config', default='/data/options.json', help='add-on options file (default: %(default)s)')
+    parser.add_argument('--database', default='/data/geocodes.sqlite3', help='database file for geocodes (default: %(default)s)')
+    parser.add_argument('--reference', default='/p2000.sqlite3', help='database file with places and capcodes (default: %(default)s)')
+    parser.add_argument('--replay', nargs='+', metavar='FILE', help='replay recorded multimon-ng output instead of reading from the dongle')
+    parser.add_argument('--speed', type=float, default=0, help='replay time scale, 1 is original speed, 0 is as fast as possible (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true', help='do not connect to the MQTT broker, only log what would be sent')
+    return parser.parse_args()
+
+
+def read_replay_lines(filenames):
+    """Yield (time, line) for every FLEX line in the recorded files.
+
+    A line may be prefixed with its original receive time as a unix timestamp,
+    for example when it was recorded using `multimon-ng ... | ts '%.s'`.
+    Otherwise the timestamp inside the FLEX line itself is used.
+    """
+
+    for filename in filenames:
+        with open(filename, encoding='utf8', errors='backslashreplace') as f:
+            for line in f:
+                received = None
+                if not line.startswith('FLEX'):
+                    prefix, _, rest = line.partition(' ')
+                    try:
+                        received = float(prefix)
+                    except ValueError:
+                        continue
+                    line = rest.lstrip()
+                if not line.startswith('FLEX'):
+                    continue
+                if received is None:
+                    try:
+                        received = calendar.timegm(time.strptime(line.split('|')[1], "%Y-%m-%d %H:%M:%S"))
+                    except (IndexError, ValueError):
+                        received = None
+                yield received, line
 
 
 class Main:
     """Main loop."""
 
-    def __init__(self):
+    def __init__(self, args):
         """Main class, start of application."""
 
         self.running = True
-        self.messages = []
+        self.dbpath = args.database
+        self.reference = args.reference
+        self.decoder = None
+        self.database = None
+        self.geocoder = None
+        self.timings = StageTimings()
+        self.metrics = None
+        # Counters for the metrics endpoint, only changed by the receive thread
+        self.lines_read = 0
+        self.lines_malformed = 0
+        self.ignored = {'capcode': 0, 'text': 0}
 
         log_message('P2000 RTL-SDR starting...')
 
         # Load configuration
-        self.config = load_config()
-
-        # Find and reset USB device
-        usb_device_index = ''
-        usb_devices = find_rtl_sdr_devices()
-        if len(usb_devices) < 1:
-            log_message('No RTL-SDR USB devices found. Exiting...')
-            sys.exit(1)
+        self.config = load_config(args.config)
+
+        # Find and reset USB device, not needed when replaying recorded data
+        if not args.replay:
+            usb_device_index = ''
+            usb_devices = find_rtl_sdr_devices()
+            if len(usb_devices) < 1:
+                log_message('No RTL-SDR USB devices found. Exiting...')
+                sys.exit(1)
 
-        usb_device_id = list(usb_devices.keys())[0]
-        usb_port = str(usb_devices[usb_device_id]['bus_address'])
-        reset_usb_device(usb_port)
+            usb_device_id = list(usb_devices.keys())[0]
+            usb_port = str(usb_devices[usb_device_id]['bus_address'])
+            reset_usb_device(usb_port)
 
         # Read config variables
         self.debug = False
         if self.config['general']['verbosity'] == 'debug':
             self.debug = True
 
+        # Repeats of a message for other capcodes are merged during the window, and not posted again until expiry
+        self.merge_window = self.config['general'].get('merge_window_ms', 1000) / 1000
+        self.dedup_expiry = self.config['general'].get('dedup_expiry', 60)
+        # A replay follows the times in the recording, it skips the quiet time between lines
+        self.clock = ReplayClock() if args.replay else time.monotonic
+        self.recent_messages = LRUCache(maxsize=1000, ttl=max(self.dedup_expiry, self.merge_window), clock=self.clock)
+        # Messages are posted by the process thread when their merge window is over
+        self.scheduler = DeadlineScheduler(self.clock)
+        # Port of the Prometheus metrics endpoint, not served when not set
+        self.metrics_port = self.config['general'].get('metrics_port')
+
         # RTLSDR parameters
         self.rtlfm_cmd = 'rtl_fm -f 169.65M -M fm -s 22050 | multimon-ng -a FLEX -t raw -'
+        self.stall_timeout = 300
         if 'rtlsdr' in self.config:
             if 'cmd' in self.config['rtlsdr']:
                 self.rtlfm_cmd = self.config['rtlsdr']['cmd']
+            if 'stall_timeout' in self.config['rtlsdr']:
+                self.stall_timeout = int(self.config['rtlsdr']['stall_timeout'])
 
         # opencage parameters
         self.use_opencage = False
-        self.opencage_disabled = False
         self.opencagetoken = ''
+        self.opencageurl = OPENCAGE_URL
         if 'opencage' in self.config:
             if 'enabled' in self.config['opencage']:
                 self.use_opencage = self.config['opencage']['enabled']
@@ -520,9 +506,25 @@ class Main:
             if 'token' in self.config['opencage']:
                 self.opencagetoken = self.config['opencage']['token']
 
+            if 'url' in self.config['opencage']:
+                self.opencageurl = self.config['opencage']['url']
+
+        # Time a message may wait for its location before it is posted without one
+        self.geocode_wait = self.config.get('opencage', {}).get('wait_budget_ms', 1500) / 1000
+
         # MQTT retain setting
         self.mqtt_retain = self.config['mqtt'].get('retain', False)
 
+        # Optional topic with every message, for consumers that want all of them
+        self.firehose_topic = self.config['mqtt'].get('firehose_topic') or None
+        self.firehose_format = self.config['mqtt'].get('firehose_format', 'json')
+        if self.firehose_format not in ('json', 'msgpack'):
+            log_message(f"Error: Unknown firehose_format '{self.firehose_format}' in config, use json or msgpack. Exiting.", True)
+            sys.exit(1)
+        if self.firehose_topic and self.firehose_format == 'msgpack' and msgpack is None:
+            log_message("Error: firehose_format msgpack needs the msgpack module, which is not installed. Exiting.", True)
+            sys.exit(1)
+
         # Load capcodes ignore data
         self.ignorecapcodes = ''
         if 'p2000_global_filters' in self.config:
@@ -530,10 +532,10 @@ class Main:
                 self.ignorecapcodes = self.config['p2000_global_filters']['ignore_capcode'].split(',')
 
         # Load text ignore data
-        self.ignoretext = ''
+        self.ignoretext = None
         if 'p2000_global_filters' in self.config:
             if 'ignore_text' in self.config['p2000_global_filters']:
-                self.ignoretext = self.config['p2000_global_filters']['ignore_text'].split(',')
+                self.ignoretext = compile_patterns(self.config['p2000_global_filters']['ignore_text'])
 
         # Set current folder so we can find the config files
         os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -556,9 +558,24 @@ class Main:
 
             self.sensors[sensor_id]['state_topic'] = '{}/{}/state'.format(self.config['mqtt']['base_topic'], sensor_id)
             self.sensors[sensor_id]['attribute_topic'] = '{}/{}/attributes'.format(self.config['mqtt']['base_topic'], sensor_id)
+            # The topics published to for every message
+            self.sensors[sensor_id]['full_state_topic'] = 'homeassistant/sensor/' + self.sensors[sensor_id]['state_topic']
+            self.sensors[sensor_id]['full_attribute_topic'] = 'homeassistant/sensor/' + self.sensors[sensor_id]['attribute_topic']
             self.sensors[sensor_id]['name'] = sensor_name
             self.sensors[sensor_id]['icon'] = str(sensor.get('icon', 'mdi:fire-truck'))
-            self.sensors[sensor_id]['sent_HA_discovery'] = False
+
+        # Compile the criteria of every sensor once instead of for every message
+        self.matchers = {id: SensorMatcher(id, sensor) for id, sensor in self.sensors.items()}
+        self.zones = CircleZones([
+            (id, *matcher.zone_coordinates, matcher.zone_radius)
+            for id, matcher in self.matchers.items() if matcher.zone_coordinates is not None
+        ])
+        self.polygons = PolygonZones(self.load_polygons())
+        # Looked up for every sensor of every message while its geocode is pending
+        self.zone_sensor_ids = set(self.zones.ids) | set(self.polygons.ids)
+        # Messages are only checked against the sensors that can match their capcodes, region or disciplines
+        self.sensor_index = SensorIndex(self.matchers)
+        log_message(f"{len(self.sensor_index)} sensors loaded, {len(self.sensor_index.fallback)} of them are checked for every message")
 
         # Build dict of TTS settings config
         self.tts_replacements = list()
@@ -573,13 +590,31 @@ class Main:
             log_message('    Pattern: {}, Replacement: {}'.format(tts['pattern'], tts['replacement']), True)
 
         # Init MQTT
-        self.mqtt_sender = MqttSender(self.config['mqtt'], self.debug)
+        spool_path = os.path.join(os.path.dirname(self.dbpath), 'mqtt_spool.sqlite3')
+        self.mqtt_sender = MqttSender(self.config['mqtt'], self.debug, args.dry_run, spool_path)
         availability_topic = '{}/status'.format(self.config['mqtt']['base_topic'])
 
         # Report ourselves 'online'
         self.mqtt_sender.publish(topic=availability_topic, payload='online', retain=True)
 
+        # Announce all sensors at once instead of each one with its first message, and again
+        # when Home Assistant sends its birth message
+        if self.config['mqtt']['ha_autodiscovery']:
+            self.publish_discovery()
+            self.mqtt_sender.subscribe('{}/status'.format(self.config['mqtt']['ha_autodiscovery_topic']), self.on_ha_status)
+
+        if args.replay:
+            self.replay(args.replay, args.speed)
+            return
+
+        if self.metrics_port:
+            try:
+                self.metrics = MetricsServer(int(self.metrics_port), self.collect_metrics)
+            except OSError as err:
+                log_message(f"Error: Cannot serve metrics on port {self.metrics_port}: {err}", True)
+
         # Start thread to get data from RTL-SDR stick
+        self.decoder = DecoderProcess(self.rtlfm_cmd, self.stall_timeout)
         receive_thread = threading.Thread(name="ReceiveThread", target=self.receive_thread_call)
         receive_thread.start()
 
@@ -588,597 +623,705 @@ class Main:
         process_thread.start()
 
         # Run the wait loop
-        while True:
-            time.sleep(1)
+        try:
+            while True:
+                time.sleep(1)
+        finally:
+            # Application is interrupted and is stopping
+            self.running = False
+            if self.metrics:
+                self.metrics.close()
+            self.scheduler.close()
+            self.decoder.stop()
+            # Let pending OpenCage queries finish, then write their results
+            if self.geocoder:
+                self.geocoder.close()
+            if self.database:
+                self.database.close()
+            self.mqtt_sender.close()
+            log_message("Application stopped")
+
+
+    def load_polygons(self):
+        """Return (id, rings) of the sensors with a polygon zone, exit when one can't be loaded."""
+
+        polygons = []
+        for id, matcher in self.matchers.items():
+            if matcher.zone_geojson is None:
+                continue
+            if matcher.zone_coordinates is not None:
+                log_message(f"Error: Sensor {id} has both a zone_radius and a zone_geojson in config. Exiting.", True)
+                sys.exit(1)
+            try:
+                rings = load_geojson(matcher.zone_geojson, self.sensors[id].get('zone_feature'))
+            except (OSError, ValueError, KeyError, TypeError, IndexError) as err:
+                log_message(f"Error: Cannot load zone_geojson '{matcher.zone_geojson}' of sensor {id}: {err}. Exiting.", True)
+                sys.exit(1)
+            if not rings:
+                log_message(f"Error: No polygons found in zone_geojson '{matcher.zone_geojson}' of sensor {id}. Exiting.", True)
+                sys.exit(1)
+            log_message(f"Sensor {id}: {len(rings)} polygon rings with {sum(map(len, rings))} points loaded from '{matcher.zone_geojson}'", self.debug)
+            polygons.append((id, rings))
+        return polygons
 
-        # Application is interrupted and is stopping
-        self.running = False
-        log_message("Application stopped")
 
+    def post_data(self, msg, sensor_ids=None, encoded=None):
+        """Filter and post sensor data, for the sensors the message can match or only the given ones.
 
-    def post_data(self, msg):
-        """Filter and post sensor data."""
+        encoded are the attributes from encode_attributes, when the caller has them already.
+        """
 
         log_message(
             f"Message '{msg.body}' received, checking criterias:", self.debug
         )
-        
-        # Loop through all sensors
-        for id in self.sensors:
-
-            self.name = ''
-            self.icon = ''
-            self.zone_radius = ''
-            self.zone_coordinates = ''
-            self.searchkeyword = ''
-            self.searchcapcode = ''
-            self.searchregion = ''
-            self.searchdiscipline = ''
-            self.searchlocation = ''
-            self.searchremark = ''
-            post = False
-
-            if 'name' in self.sensors[id]:
-                self.name = self.sensors[id]['name']
-
-            if 'icon' in self.sensors[id]:
-                self.icon = self.sensors[id]['icon']
-            
-            if "zone_latitude" in self.sensors[id] and "zone_longitude" in self.sensors[id] and "zone_radius" in self.sensors[id]:
-                self.zone_coordinates = (
-                    float(self.sensors[id]['zone_latitude']),
-                    float(self.sensors[id]['zone_longitude'])
-                )
-                self.zone_radius = self.sensors[id]['zone_radius']
 
-            if 'keyword' in self.sensors[id]:
-                self.searchkeyword = self.sensors[id]['keyword'].split(',')
+        # Set before the candidates are looked up: a repeat that the receive thread merges
+        # from now on schedules post_merged, also when its capcodes come in too late for them
+        msg.is_posted = True
 
-            if 'capcode' in self.sensors[id]:
-                self.searchcapcode = self.sensors[id]['capcode'].split(',')
+        # Sensors with a zone have to wait for the location if geocoding takes too long
+        geocode_pending = msg.geocode_future is not None and not self.wait_for_geocode(msg)
+        started = time.perf_counter()
+        publishing = 0.0
 
-            if 'region' in self.sensors[id]:
-                self.searchregion = self.sensors[id]['region'].split(',')
+        # Measure the distance to all zones at once, the polygons a location is in are at distance 0
+        if msg.latitude and msg.longitude:
+            msg.distances = self.zones.check(msg.latitude, msg.longitude)
+            msg.distances.update(dict.fromkeys(self.polygons.check(msg.latitude, msg.longitude), 0.0))
 
-            if 'discipline' in self.sensors[id]:
-                self.searchdiscipline = self.sensors[id]['discipline'].split(',')
+        # Loop through all sensors
+        for id in (self.sensor_index.candidates(msg) if sensor_ids is None else sensor_ids):
 
-            if 'location' in self.sensors[id]:
-                self.searchlocation = self.sensors[id]['location'].split(',')
+            if geocode_pending and id in self.zone_sensor_ids:
+                continue
 
-            if 'remark' in self.sensors[id]:
-                self.searchremark = self.sensors[id]['remark'].split(',')
+            if not self.matchers[id].match(msg, self.debug):
+                continue
 
-            # If location is known and radius is specified in config calculate distance and check radius
-            if msg.latitude and msg.longitude and self.zone_radius:
-                event_coordinates = (msg.latitude, msg.longitude)
-                msg.distance = round(
-                    geodesic(
-                        self.zone_coordinates, event_coordinates
-                    ).km,
-                    2,
-                )
-                if msg.distance <= float(self.zone_radius):
-                    log_message(
-                        f"Distance MATCHED {msg.distance} km, inside {self.zone_radius} km radius", self.debug
-                    )
-                else:
-                    log_message(
-                        f"Distance UNMATCHED {msg.distance} km, outside {self.zone_radius} km radius", self.debug
-                    )
-                    msg.is_posted = True
-                    continue
-                post = True
+            log_message(
+                f"Message MATCHED criterias, updating sensor", self.debug
+            )
+            # Serialized once, all sensors get the same attributes
+            published = time.perf_counter()
+            if encoded is None:
+                encoded = self.encode_attributes(msg)
+            self.publish_sensor(id, msg, encoded=encoded)
+            if not msg.posted_sensors:
+                msg.posted_sensors = []
+            msg.posted_sensors.append(id)
+            publishing += time.perf_counter() - published
+
+        if sensor_ids is None and self.firehose_topic:
+            published = time.perf_counter()
+            self.publish_firehose(msg)
+            publishing += time.perf_counter() - published
+
+        # Zones and sensor criteria, the rest is publishing
+        self.timings.record('match', time.perf_counter() - started - publishing)
+        if publishing:
+            self.timings.record('publish', publishing)
+
+
+    def message_attributes(self, msg):
+        """Return the attributes of a message that are the same for all sensors."""
+
+        return {
+            "time received": msg.timestamp,
+            "group id": msg.groupid,
+            "receivers": msg.receivers,
+            "capcodes": msg.capcodes,
+            "priority": msg.priority,
+            "disciplines": ", ".join(msg.disciplines),
+            "raw message": msg.message_raw,
+            "region": msg.region,
+            "location": msg.location,
+            "postal code": msg.postalcode,
+            "city": msg.city,
+            "address": msg.address,
+            "street": msg.street,
+            "remarks": msg.remarks,
+            "longitude": msg.longitude,
+            "latitude": msg.latitude,
+            "opencage": msg.opencage,
+            "mapurl": msg.mapurl,
+        }
+
+
+    def encode_attributes(self, msg):
+        """Return the JSON attributes payload of a message as bytes before and after the distance.
+
+        The distance to the zone is the only attribute that differs per sensor.
+        """
+
+        attributes = json.dumps(self.message_attributes(msg))
+        head = (attributes[:-1] + ', "distance": ').encode()
+        tail = (', "tts": ' + json.dumps(msg.tts) + '}').encode()
+        return head, tail
+
+
+    def publish_firehose(self, msg):
+        """Publish a message once to the firehose topic, with the sensors it matched."""
+
+        data = self.message_attributes(msg)
+        data['tts'] = msg.tts
+        data['distances'] = msg.distances or {}
+        data['sensors'] = msg.posted_sensors
+        if self.firehose_format == 'msgpack':
+            payload = msgpack.packb(data)
+        else:
+            payload = json.dumps(data, separators=(',', ':')).encode()
+        self.mqtt_sender.publish(topic=self.firehose_topic, payload=payload)
+
+
+    def publish_discovery(self):
+        """Send the MQTT auto discovery payloads of all sensors to Home Assistant."""
+
+        log_message(f"Sending MQTT autodiscovery payloads of {len(self.sensors)} sensors to Home Assistant", self.debug)
+        announcements = []
+        for sensor in self.sensors.values():
+            discover_topic = '{}/sensor/p2000_rtlsdr/{}/config'.format(self.config['mqtt']['ha_autodiscovery_topic'], sensor['id'])
+            discover_payload = {
+                'name': sensor['name'],
+                'unique_id': str(sensor['id']),
+                'icon': sensor['icon'],
+                'availability_topic': '{}/status'.format(self.config['mqtt']['base_topic']),
+                'force_update': True,
+                'state_topic': sensor['full_state_topic'],
+                'json_attributes_topic': sensor['full_attribute_topic']
+            }
+            announcements.append((discover_topic, json.dumps(discover_payload)))
+        # Sent straight to the broker and again after a reconnect, the alerts don't wait for them
+        self.mqtt_sender.announce(announcements)
 
-            # Check for matched text/keyword
-            if len(self.searchkeyword):
-                if not check_filter(self.searchkeyword, msg.body):
-                    log_message(
-                        f"Keywords UNMATCHED '{', '.join(self.searchkeyword)}'", self.debug
-                    )
-                    msg.is_posted = True
-                    continue
-                log_message(
-                    f"Keywords MATCHED '{', '.join(self.searchkeyword)}'", self.debug
-                )
-                post = True
 
-            # Check for matched regions
-            if len(self.searchregion):
-                if not check_filter(self.searchregion, msg.region):
-                    log_message(
-                        f"Regions UNMATCHED '{', '.join(self.searchregion)}'", self.debug
-                    )
-                    msg.is_posted = True
-                    continue
-                log_message(
-                    f"Regions MATCHED '{', '.join(self.searchregion)}'", self.debug
-                )
-                post = True
+    def on_ha_status(self, message):
+        """Announce the sensors again when Home Assistant (re)starts, it forgets them without retained configs."""
 
-            # Check for matched location
-            if len(self.searchlocation):
-                if not check_filter(self.searchlocation, msg.location):
-                    log_message(
-                        f"Locations UNMATCHED '{', '.join(self.searchlocation)}'", self.debug
-                    )
-                    msg.is_posted = True
-                    continue
-                log_message(
-                    f"Locations MATCHED '{', '.join(self.searchlocation)}'", self.debug
-                )
-                post = True
+        # A retained status is an old one, the sensors were announced at startup
+        if message.payload == b'online' and not message.retain:
+            log_message('Home Assistant is online, sending MQTT autodiscovery payloads again', self.debug)
+            self.scheduler.call_soon(self.publish_discovery)
 
-            # Check for matched remark
-            if len(self.searchremark):
-                if not check_filter(self.searchregion, msg.region):
-                    log_message(
-                        f"Remarks UNMATCHED '{', '.join(self.searchremark)}'", self.debug
-                    )
-                    msg.is_posted = True
-                    continue
-                log_message(
-                    f"Remarks MATCHED '{', '.join(self.searchremark)}'", self.debug
-                )
-                post = True
 
-            # Check for matched regions
-            if len(self.searchregion):
-                if not check_filter(self.searchregion, msg.region):
-                    log_message(
-                        f"Regions UNMATCHED '{', '.join(self.searchregion)}'", self.debug
-                    )
-                    msg.is_posted = True
-                    continue
-                log_message(
-                    f"Regions MATCHED '{', '.join(self.searchregion)}'", self.debug
-                )
-                post = True
+    def publish_sensor(self, id, msg, state=True, encoded=None):
+        """Post data to Home Assistant via MQTT topic."""
 
-            # Check for matched capcodes
-            if len(self.searchcapcode):
-                if not check_filter_with_list(self.searchcapcode, msg.capcodes):
-                    log_message(
-                        f"Capcodes UNMATCHED '{', '.join(self.searchcapcode)}'", self.debug
-                    )
-                    msg.is_posted = True
-                    continue
-                log_message(
-                    f"Capcodes MATCHED '{', '.join(msg.capcodes)}'", self.debug
-                )
-                post = True
+        head, tail = encoded or self.encode_attributes(msg)
+        distance = msg.distances.get(id, "") if msg.distances else ""
+        payload = head + json.dumps(distance).encode() + tail
+        self.mqtt_sender.publish(topic=self.sensors[id]['full_attribute_topic'], payload=payload, retain=self.mqtt_retain)
+        if state:
+            self.mqtt_sender.publish(topic=self.sensors[id]['full_state_topic'], payload=msg.body, retain=self.mqtt_retain)
 
-            # Check for matched disciplines
-            if len(self.searchdiscipline):
-                if not check_filter(self.searchdiscipline, msg.disciplines):
-                    log_message(
-                        f"Disciplines UNMATCHED '{', '.join(self.searchdiscipline)}'", self.debug
-                    )
-                    msg.is_posted = True
-                    continue
-                log_message(
-                    f"Disciplines MATCHED '{', '.join(msg.disciplines)}'", self.debug
-                )
-                post = True
+        log_message(f"Sensor '{self.sensors[id]['name']}': '{msg.body}'", self.debug)
 
-            # No other matches are valid, if distance is not valid, skip
-            if post is False:
-                log_message(
-                    f"Message IGNORED no criterias matched", self.debug
-                )
-                msg.is_posted = True
-                continue
-            else:
-                log_message(
-                    f"Message MATCHED criterias, updating sensor", self.debug
-                )
 
-            """Post data to Home Assistant via MQTT topic."""
-            attributes = {
-                "time received": msg.timestamp,
-                "group id": msg.groupid,
-                "receivers": msg.receivers,
-                "capcodes": msg.capcodes,
-                "priority": msg.priority,
-                "disciplines": msg.disciplines,
-                "raw message": msg.message_raw,
-                "region": msg.region,
-                "location": msg.location,
-                "postal code": msg.postalcode,
-                "city": msg.city,
-                "address": msg.address,
-                "street": msg.street,
-                "remarks": msg.remarks,
-                "longitude": msg.longitude,
-                "latitude": msg.latitude,
-                "opencage": msg.opencage,
-                "mapurl": msg.mapurl,
-                "distance": msg.distance,
-                "tts": msg.tts,
-            }
+    def wait_for_geocode(self, msg):
+        """Check a pending geocode, post_message already waited for it until the wait budget was used up.
 
-            if self.config['mqtt']['ha_autodiscovery']:
-                # if HA Autodiscovery is enabled, send the MQTT auto discovery payload once for each sensor
-                if not self.sensors[id]['sent_HA_discovery']:
-                    log_message('Sending MQTT autodiscovery payload to Home Assistant...', self.debug)
-                    discover_topic = '{}/sensor/p2000_rtlsdr/{}/config'.format(self.config['mqtt']['ha_autodiscovery_topic'], self.sensors[id]['id'])
-                    discover_payload = {
-                        'name': self.sensors[id]['name'],
-                        'unique_id': str(self.sensors[id]['id']),
-                        'icon': self.sensors[id]['icon'],
-                        'availability_topic': '{}/status'.format(self.config['mqtt']['base_topic']),
-                        'force_update': True,
-                        'state_topic': 'homeassistant/sensor/' + self.sensors[id]['state_topic'],
-                        'json_attributes_topic': 'homeassistant/sensor/' + self.sensors[id]['attribute_topic']
-                    }
-                    self.mqtt_sender.publish(topic=discover_topic, payload=json.dumps(discover_payload), qos=1, retain=True)
-                    self.sensors[id]['sent_HA_discovery'] = True
-
-            attribute_topic = 'homeassistant/sensor/' + self.sensors[id]['attribute_topic']
-            state_topic = 'homeassistant/sensor/' + self.sensors[id]['state_topic']
-            self.mqtt_sender.publish(topic=attribute_topic, payload=json.dumps(attributes), retain=self.mqtt_retain)
-            self.mqtt_sender.publish(topic=state_topic, payload=msg.body, retain=self.mqtt_retain)
-
-            log_message(f"Sensor '{self.sensors[id]['name']}': '{msg.body}'", self.debug)
+        Return True when the location is known (or will never be), False when it is still pending.
+        """
 
-        msg.is_posted = True
+        if msg.geocode_future.done():
+            self.apply_geocode(msg, self.geocode_result(msg))
+            return True
+        log_message(f"Geocoding of '{msg.address}' not finished, posting without location", self.debug)
+        # Hand the message back to the process thread once the result is in
+        msg.geocode_future.add_done_callback(lambda future: self.scheduler.call_soon(self.post_geocoded, msg))
+        return False
+
+    def geocode_result(self, msg):
+        """Return the result of a finished geocode, None when it failed so the message is posted anyway."""
+
+        err = msg.geocode_future.exception()
+        if err is not None:
+            log_message(f"{type(err).__name__}: '{err}' occurred while geocoding '{msg.address}'", True)
+            return None
+        return msg.geocode_future.result()
+
+    def apply_geocode(self, msg, geocode):
+        """Store a geocode result in the message."""
+
+        msg.geocode_future = None
+        if geocode:
+            msg.latitude, msg.longitude, msg.mapurl = geocode
+        msg.opencage = f"enabled: {self.use_opencage} ratelimit: {self.geocoder.disabled} ({self.geocoder.rate_remaining}) geocoded: {bool(geocode)}"
+
+    def post_geocoded(self, msg):
+        """Post the location dependent updates of a message that was geocoded after it was posted."""
+
+        if msg.geocode_future is None:
+            return
+        timer = self.timings.timer()
+        geocode = self.geocode_result(msg)
+        self.apply_geocode(msg, geocode)
+        encoded = self.encode_attributes(msg) if msg.posted_sensors else None
+        if geocode:
+            # Sensors that matched already get the coordinates in their attributes
+            for id in msg.posted_sensors:
+                self.publish_sensor(id, msg, state=False, encoded=encoded)
+        # Zone sensors could only be checked now, in the order of the config like all other sensors
+        self.post_data(msg, [id for id in self.matchers if id in self.zone_sensor_ids and id not in msg.posted_sensors], encoded)
+        timer.lap('late geo')
+
+    def post_merged(self, msg):
+        """Post the updates of a message that received more capcodes after it was posted."""
+
+        # Sensors that matched already get the new capcodes in their attributes, the others are checked again
+        timer = self.timings.timer()
+        encoded = self.encode_attributes(msg) if msg.posted_sensors else None
+        for id in msg.posted_sensors:
+            self.publish_sensor(id, msg, state=False, encoded=encoded)
+        self.post_data(msg, [id for id in self.sensor_index.candidates(msg) if id not in msg.posted_sensors], encoded)
+        timer.lap('merge')
+
+    def open_database(self):
+        """Open the database in the calling thread."""
 
+        self.database = Database(self.dbpath, self.reference)
+        self.database.database_stats()
+
+        # Keep all places in memory, they are looked up for almost every message
+        self.unknown_locations = NegativeCache(maxsize=5000, ttl=24 * 3600)
+        self.places = PlaceIndex(self.database.load_places())
+        log_message(f"Loaded {len(self.places)} places and {len(self.places.abbreviations)} abbreviations in memory")
+        self.capcodes = CapcodeIndex(self.database.load_capcodes())
+        log_message(f"Loaded {len(self.capcodes)} capcodes in memory")
+        self.database.drop_loaded_tables()
+
+        self.geocoder = Geocoder(self.database, self.opencagetoken, self.debug, url=self.opencageurl, use_opencage=self.use_opencage)
 
     def receive_thread_call(self):
         """Thread for receiving and parsing with RTL-SDR."""
 
         # Open the database
-        self.database = Database()
-        self.database.database_stats()
-        self.skipthesekeywords = []
+        self.open_database()
 
-        log_message(f"RTL-SDR process starting with: {self.rtlfm_cmd}")
-        multimon_ng = subprocess.Popen(
-            self.rtlfm_cmd, stdout=subprocess.PIPE, shell=True
-        )
         log_message("Message receive thread started")
-        while self.running:
-            # Read line from process
-            line = multimon_ng.stdout.readline()
+        # The decoder restarts the RTL-SDR process by itself when it dies or stalls
+        for line in self.decoder.lines():
+            if not self.running:
+                break
+            self.lines_read += 1
+            timer = self.timings.timer()
             try:
                 line = line.decode("utf8", "backslashreplace")
             except UnicodeDecodeError:
                 log_message(f"Error while decoding utf8 string: '{line}'", True)
                 line = ""
-            multimon_ng.poll()
+            timer.lap('decode')
             if line.startswith("FLEX") and line.__contains__("ALN"):
-                line_data = line.split("|")
-                timestamp = line_data[1]
-                groupid = line_data[3].strip()
-                capcodes = line_data[4].strip()
-                message = line_data[6].strip()
-                priority = p2000_get_prio(message)
-                location = ""
-                postalcode = ""
-                city = ""
-                address = ""
-                street = ""
-                longitude = ""
-                latitude = ""
-                opencage = ""
-                distance = ""
-                mapurl = ""
-                geocoded = False
-                rate_remaining = 9999
-
-                log_message(line.strip(), self.debug)
-
-                # Global filters
-                # Check capcodes first, only if they are defined in config global filter
-                if self.ignorecapcodes:
-                    for capcode in capcodes.split(" "):
-                        if len(capcodes.split(" ")) == 1:
-                            if capcode in self.ignorecapcodes:
-                                log_message(
-                                    f"Message '{message}' ignored because it contains only one capcode '{capcode}' and MATCHED ignore_capcodes", self.debug
-                                )
-                                continue
-
-                # Check for ignore texts if define in global filter
-                if self.ignoretext:
-                    if check_filter(self.ignoretext, message):
+                self.handle_line(line, timer)
+
+        log_message("Message receive thread stopped")
+
+
+    def handle_line(self, line, timer=None):
+        """Parse a FLEX line, enrich it and queue it as a message."""
+
+        if timer is None:
+            timer = self.timings.timer()
+
+        record = parse_line(line)
+        if record is None:
+            log_message(f"Malformed FLEX line ignored: '{line.strip()}'", self.debug)
+            self.lines_malformed += 1
+            return
+        timestamp = record.timestamp
+        groupid = record.groupid
+        capcodes = record.capcodes
+        message = record.body
+        priority = record.priority
+        location = ""
+        postalcode = record.postalcode
+        city = record.city
+        address = record.address
+        street = record.street
+        longitude = ""
+        latitude = ""
+        opencage = ""
+        mapurl = ""
+        geocoded = False
+
+        log_message(record.raw, self.debug)
+        timer.lap('parse')
+
+        # Global filters
+        # Check capcodes first, only if they are defined in config global filter
+        if self.ignorecapcodes:
+            for capcode in capcodes:
+                if len(capcodes) == 1:
+                    if capcode in self.ignorecapcodes:
                         log_message(
-                            f"Message '{message}' ignored MATCHED ignore_text", self.debug
+                            f"Message '{message}' ignored because it contains only one capcode '{capcode}' and MATCHED ignore_capcodes", self.debug
                         )
-                        continue
+                        self.ignored['capcode'] += 1
+                        return
 
-                # Get address info if any, look for valid postalcode and get the two words around them
-                # A2 (DIA: ja) AMBU 17106 Schiedamseweg 3134BA Vlaardingen VLAARD bon 8576
-                # or with only postalcode number
-                # A1 13108 Surinameplein 1058 Amsterdam 12006
-                addr = re.search(r"(\w*.) ([1-9][0-9]{3})([A-Z]{2})? (.\w*)", message)
-                if addr:
-                    street = addr.group(1)
-                    groups = len(addr.groups())
-                    if groups == 4:
-                        # Add space between digits and letter of postalcode to get better OpenCage results
-                        postalcode = f"{addr.group(2)} {addr.group(3)}"
-                        city = addr.group(4)
-                    elif groups == 3:
-                        postalcode = {addr.group(2)}
-                        city = addr.group(3)
-                    address = f"{street} {postalcode} {city}"
-
-                # Try to get city only when there is one after a prio
-                # A1 Breda
-                else:
-                    loc = re.search(r"(^A\s?1|\s?A\s?2|B\s?1|^B\s?2|^B\s?3|PRIO\s?1|^P\s?1|PRIO\s?2|^P\s?2) (.\w*)", message)
-                    #if loc and loc.group(2) in self.plaatsnamen:
-                    if loc and self.database.check_plaatsnaam(loc.group(2).replace("'","")):
-                        city = loc.group(2)
-                    else:
-                        # Find all uppercase words with len 3 or longer and check if there is a valid city name amoung them
-                        # A2 Ambulancepost Moordrecht Middelweg MOORDR V
-                        afkortingen = re.findall("[A-Z]{3,}", message)
-                        if afkortingen:
-                            log_message(f"Searching for a city using abbrev. in '{afkortingen}'", self.debug)
-                        for afkorting in afkortingen:
-                            if afkorting not in self.skipthesekeywords:
-                                log_message(f"Checking if '{afkorting}' is a city abbrev.", self.debug)
-                                if self.database.check_pltsnm(afkorting):
-                                    city = self.database.find_plaatsnaam(afkorting)
-                                    log_message(f"City '{city}' found", self.debug)
-                                    # If uppercase city is found, grab first word before that city name, since it's likely to be the streetname
-                                    addr = re.search(rf"(\w*.) ({afkorting})", message)
-                                    if addr:
-                                        street = addr.group(1)
-                                    address = f"{street} {city}"
-                                    # Change uppercase city to normal city in message
-                                    message = re.sub(afkorting, city, message)
-                                else:
-                                    self.skipthesekeywords.append(afkorting)
-
-                    # If no address is found, do a wild guess to get a city name at least
-                    if not address:
-                        # Strip all status info from message
-                        strip = re.sub(r"(^A\s?1|\s?A\s?2|B\s?1|^B\s?2|^B\s?3|PRIO\s?1|^P\s?1|PRIO\s?2|^P\s?2|^PRIO\s?3|^P\s?3|^PRIO\s?4|^P\s?4)(\W\d{2,}|.*(BR)\b|)|(rit:|rit|bon|bon:|ambu|dia)\W\d{5,8}|\b\d{5,}$|( : )|\(([^\)]+)\)( \b\d{5,}|)|directe (\w*)|(-)+/gi", "", message, flags=re.I)
-                        # Strip any double and leading/trailing spaces from message 
-                        strip = re.sub(r"(^[ \t]+|[ \t]+$)", "", strip.strip())
-                        # Search in leftover message for a city corresponding to City list
-                        log_message(f"Searching for a city in '{strip}'", self.debug)
-
-                        for plaatsnaam in strip.replace("'","").split(" "):
-                            if plaatsnaam not in self.skipthesekeywords:
-                                log_message(f"Checking if '{plaatsnaam}' is a city", self.debug)
-                                if self.database.check_plaatsnaam(plaatsnaam):
-                                    log_message(f"City '{plaatsnaam}' found", self.debug)
-                                    # Find first word left from city
-                                    plaatsnamen_strip = re.search(
-                                        rf"\w*.[a-z|A-Z] \b{plaatsnaam}\b", strip
-                                    )
-                                    if plaatsnamen_strip:
-                                        # Final non-address symbols strip
-                                        address = re.sub(
-                                            r"(- )|(\w[0-9] )", "", plaatsnamen_strip.group(0)
-                                        )
-                                        city = plaatsnaam
-                                        log_message(
-                                            f"Address found: '{address}'", self.debug
-                                        )
-                                else:
-                                    self.skipthesekeywords.append(plaatsnaam)
-
-                # Get more info using the capcodes data
-                for capcode in capcodes.split(" "):
-                    result = self.database.find_capcode(capcode)
-                    if result:
-                        log_message(f"Capcode {capcode}: Disc: '{result['discipline']}' Reg: '{result['region']}' Loc: '{result['location']}' Descr: '{result['description']}' Remark: '{result['remark']}'", self.debug)
-                        description = f"{result['description']} ({capcode})"
-                        discipline = result['discipline']
-                        region = result['region']
-                        location = result['location']
-                        remark = result['remark']
-                    else:
-                        description = capcode
-                        discipline = ""
-                        region = ""
-                        remark = ""
-
-                log_message(f"DEBUG message post: {message}", self.debug)
-
-                # If this message was already received, only add extra info
-                if len(self.messages) > 0 and self.messages[0].body == message:
-                    if self.messages[0].receivers == "":
-                        self.messages[0].receivers = description
-                    elif description:
-                        self.messages[0].receivers += ", " + description
-
-                    if self.messages[0].disciplines == "":
-                        self.messages[0].disciplines = discipline
-                    elif discipline:
-                        self.messages[0].disciplines += ", " + discipline
-                    if self.messages[0].remarks == "":
-                        self.messages[0].remarks = remark
-                    elif remark:
-                        self.messages[0].remarks += ", " + remark
-
-                    if self.messages[0].region == "":
-                        self.messages[0].region = region
-
-                    self.messages[0].capcodes.append(capcode)
-                    self.messages[0].location = location
-                    self.messages[0].postalcode = postalcode
-                    self.messages[0].city = city
-                    self.messages[0].street = street
-                    self.messages[0].address = address
-                else:
-                    # TODO
-                    # After midnight (UTC), reset the opencage disable
-                    hour = datetime.now(timezone.utc)
-                    if (
-                        hour.hour >= 0
-                        and hour.minute >= 1
-                        and hour.hour < 1
-                        and hour.minute < 15
-                    ):
-                        self.opencage_disabled = False
-
-                    # If address is filled and OpenCage is enabled check for GPS coordinates
-                    # First check local GPS database
-                    if address and self.use_opencage:
-                        try:
-                            log_message(f"Checking gps database for '{address}'", self.debug)
-                            geocode = self.database.find_geocode(address.replace("'", ""))
-                            if geocode:
-                                log_message(
-                                    f"Address '{address}' was found in geocode database", self.debug
-                                )
-                                latitude = geocode["latitude"]
-                                longitude = geocode["longitude"]
-                                mapurl = geocode["mapurl"]
-                                log_message(
-                                    f"GPS database results: {latitude}, {longitude}, {mapurl}", self.debug
-                                )
-                                geocoded = True
-                        except KeyError as err:
-                            log_message(
-                                    f"Address '{address}' was not found in gps database", self.debug
-                                )
-
-                    # If not found in GPS database file, check opencage
-                    # If address is filled and OpenCage is enabled check for GPS coordinates and mapurl
-                    if (
-                        address
-                        and self.use_opencage
-                        and (self.opencage_disabled is False)
-                        and (geocoded is False)
-                    ):
-                        try:
-                            log_message(
-                                    f"OpenCage query: '{address}'", self.debug
-                            )
-                            locations = OpenCageGeocode(address, self.opencagetoken)
-                            log_message(f"OpenCageGecode: {locations}", self.debug)
-                            if int(locations['total_results']) > 0:
-
-                                postcode = ""
-                                road = ""
-                                oc_address = ""
-                                datatype = locations['results'][0]['components']['_type']
-
-                                # Plaats can be in city, town or village field
-                                if 'city' in locations['results'][0]['components']:
-                                    plaats = locations['results'][0]['components']['city']
-                                if 'town' in locations['results'][0]['components']:
-                                    plaats = locations['results'][0]['components']['town']
-                                if 'village' in locations['results'][0]['components']:
-                                    plaats = locations['results'][0]['components']['village']
-                                if 'road' in locations['results'][0]['components']:
-                                    road = locations['results'][0]['components']['road']
-                                if 'postcode' in locations['results'][0]['components']:
-                                    postcode = locations['results'][0]['components']['postcode']
-
-                                if plaats and plaats in address or (plaats == 'Den Haag' and 's-Gravenhage' in address):
-                                    latitude = locations['results'][0]['geometry']['lat']
-                                    longitude = locations['results'][0]['geometry']['lng']
-                                    mapurl = locations['results'][0]['annotations']['OSM']['url']
-                                    rate_remaining = locations['rate']['remaining']
-                                    
-                                    # OpenCage returned a different postal code, keep the original but update rest of addresss
-                                    if datatype == 'city':
-                                        oc_address = f"{plaats}"
-                                    elif postcode and road:
-                                        oc_address = f"{road}, {postcode} {plaats}"
-
-                                    log_message(
-                                        f"OpenCage results: {datatype} {latitude}, {longitude}, '{oc_address}', '{mapurl}'", self.debug
-                                    )
-
-                                    try:
-                                        self.database.store_geocode(address, datatype, str(longitude), str(latitude), postcode, street, plaats, oc_address, mapurl)
-
-                                        geocoded = True
-                                    except:
-                                        log_message(
-                                            f"Error while trying to store geocode data in database: '{address}'", True
-                                        )
-                                else:
-                                    latitude = ""
-                                    longitude = ""
-                                    mapurl = ""
-                                    log_message(f"OpenCage API returned invalid location for given address (or returned wrong city for example): '{plaats}'", self.debug)
-                            else:
-                                latitude = ""
-                                longitude = ""
-                                mapurl = ""
-                                log_message(f"OpenCage API didn't return any location data for this address: '{address}'", self.debug)
-                            
-                        except IndexError as err:
-                            log_message(f"IndexError: '{err}' occurred while parsing: '{locations}'", True)
-                            latitude = ""
-                            longitude = ""
-                            mapurl = ""
-                            geocoded = False
-                        except (RateLimitExceededError) as err:
-                            log_message(err, True)
-                            # Rate limit reached, disable opencage until midnight
-                            self.opencage_disabled = True
-                        except (InvalidInputError, NotAuthorizedError, ForbiddenError, UnknownError) as err:
-                            log_message(err, True)
-                    else:
-                        geocoded = False
-
-                    #Replace all TTS replacement
-                    tts = message
-                    for tts_replacement in self.tts_replacements:
-                        tts = re.sub(tts_replacement['pattern'], tts_replacement['replacement'], tts)
-  
-                    opencage = f"enabled: {self.use_opencage} ratelimit: {self.opencage_disabled} ({rate_remaining}) geocoded: {geocoded}"
-
-                    msg = MessageItem()
-                    msg.groupid = groupid
-                    msg.receivers = description
-                    msg.capcodes = capcodes.split(" ")
-                    msg.body = message
-                    msg.message_raw = line.strip()
-                    msg.disciplines = discipline
-                    msg.priority = priority
-                    msg.region = region
-                    msg.location = location
-                    msg.postalcode = postalcode
-                    msg.longitude = longitude
-                    msg.latitude = latitude
-                    msg.city = city
-                    msg.street = street
-                    msg.address = address
-                    msg.remarks = remark
-                    msg.opencage = opencage
-                    msg.mapurl = mapurl
-                    msg.timestamp = to_local_datetime(timestamp)
-                    msg.is_posted = False
-                    msg.distance = distance
-                    msg.tts = tts
-                    self.messages.insert(0, msg)
-
-            # TODO
-            # Limit the message list size
-            if len(self.messages) > 20:
-                self.messages = self.messages[:20]
+        # Check for ignore texts if define in global filter
+        if self.ignoretext:
+            if self.ignoretext.match(message):
+                log_message(
+                    f"Message '{message}' ignored MATCHED ignore_text", self.debug
+                )
+                self.ignored['text'] += 1
+                return
 
-        log_message("Message receive thread stopped")
+        timer.lap('filter')
+
+        # The parser already extracted the address when there is a valid postalcode,
+        # otherwise try to get city only when there is one after a prio
+        # Messages that gave no city before are skipped, they often come in several times
+        if not address and record.body not in self.unknown_locations:
+            if record.prio_city and self.places.is_city(record.prio_city):
+                city = record.prio_city
+            else:
+                # Check if there is a valid city name among the uppercase words
+                afkortingen = record.abbreviations
+                if afkortingen:
+                    log_message(f"Searching for a city using abbrev. in '{afkortingen}'", self.debug)
+                for afkorting in afkortingen:
+                    found = self.places.find_city(afkorting)
+                    if found:
+                        city = found
+                        log_message(f"City '{city}' found", self.debug)
+                        # If uppercase city is found, grab first word before that city name, since it's likely to be the streetname
+                        addr = re.search(rf"(\w*.) ({afkorting})", message)
+                        if addr:
+                            street = addr.group(1)
+                        address = f"{street} {city}"
+                        # Change uppercase city to normal city in message
+                        message = re.sub(afkorting, city, message)
+
+            # If no address is found, do a wild guess to get a city name at least
+            if not address:
+                # Strip all status info and leading/trailing spaces from message
+                strip = record.stripped()
+                # Search in leftover message for a city corresponding to City list
+                log_message(f"Searching for a city in '{strip}'", self.debug)
+
+                for plaatsnaam in self.places.find_cities(strip):
+                    log_message(f"City '{plaatsnaam}' found", self.debug)
+                    # Find first word left from city
+                    plaatsnamen_strip = re.search(
+                        rf"\w*.[a-z|A-Z] \b{re.escape(plaatsnaam)}\b", strip
+                    )
+                    if plaatsnamen_strip:
+                        # Final non-address symbols strip
+                        address = ADDRESS_CLEANUP_RE.sub(
+                            "", plaatsnamen_strip.group(0)
+                        )
+                        city = plaatsnaam
+                        log_message(
+                            f"Address found: '{address}'", self.debug
+                        )
+
+            if not city:
+                self.unknown_locations.add(record.body)
+
+        # Get more info using the capcodes data
+        descriptions = []
+        disciplines = []
+        remarks = []
+        region = ""
+        for capcode, result in zip(capcodes, self.capcodes.resolve_capcodes(capcodes)):
+            if result:
+                log_message(f"Capcode {capcode}: Disc: '{result.discipline}' Reg: '{result.region}' Loc: '{result.location}' Descr: '{result.description}' Remark: '{result.remark}'", self.debug)
+                descriptions.append(f"{result.description} ({capcode})")
+                if result.discipline and result.discipline not in disciplines:
+                    disciplines.append(result.discipline)
+                if result.remark:
+                    remarks.append(result.remark)
+                if not region:
+                    region = result.region
+                location = result.location
+            else:
+                descriptions.append(capcode)
+        description = ", ".join(descriptions)
+        remark = ", ".join(remarks)
+
+        log_message(f"DEBUG message post: {message}", self.debug)
+        timer.lap('enrich')
+
+        # If this message was already received, only add extra info, also when other messages came in between
+        key = (record.body, groupid)
+        previous = self.recent_messages.get(key)
+        if previous is not None:
+            if previous.receivers == "":
+                previous.receivers = description
+            elif description:
+                previous.receivers += ", " + description
+
+            previous.disciplines += tuple(discipline for discipline in disciplines if discipline not in previous.disciplines)
+            if previous.remarks == "":
+                previous.remarks = remark
+            elif remark:
+                previous.remarks += ", " + remark
+
+            if previous.region == "":
+                previous.region = region
+
+            previous.capcodes.extend(capcodes)
+            previous.location = location
+            previous.postalcode = postalcode
+            previous.city = city
+            previous.street = street
+            previous.address = address
+
+            # Posted already, the process thread updates the sensors with the extra capcodes
+            if previous.is_posted:
+                log_message(f"Message '{message}' was posted already, merging capcodes {', '.join(capcodes)}", self.debug)
+                self.scheduler.call_soon(self.post_merged, previous)
+        else:
+            # If address is filled check for GPS coordinates, the geocoder tries its caches,
+            # the postcode tables and the local GPS database before OpenCage (if enabled)
+            # When OpenCage has to be asked this happens in the background, the message
+            # is posted as soon as the result is in or the wait budget is used up
+            geocode_future = None
+            if address:
+                geocode = self.geocoder.geocode(address, street, postalcode, city)
+                if isinstance(geocode, Future):
+                    geocode_future = geocode
+                elif geocode:
+                    latitude, longitude, mapurl = geocode
+                    geocoded = True
+
+            timer.lap('geocode')
+
+            #Replace all TTS replacement
+            tts = message
+            for tts_replacement in self.tts_replacements:
+                tts = re.sub(tts_replacement['pattern'], tts_replacement['replacement'], tts)
+
+            opencage = f"enabled: {self.use_opencage} ratelimit: {self.geocoder.disabled} ({self.geocoder.rate_remaining}) geocoded: {geocoded}"
+
+            msg = MessageItem()
+            msg.timereceived = self.clock()
+            msg.groupid = groupid
+            msg.receivers = description
+            msg.capcodes = capcodes
+            msg.body = message
+            msg.message_raw = record.raw
+            msg.disciplines = tuple(disciplines)
+            msg.priority = priority
+            msg.region = region
+            msg.location = location
+            msg.postalcode = postalcode
+            msg.longitude = longitude
+            msg.latitude = latitude
+            msg.city = city
+            msg.street = street
+            msg.address = address
+            msg.remarks = remark
+            msg.opencage = opencage
+            msg.mapurl = mapurl
+            msg.timestamp = to_local_datetime(timestamp)
+            msg.is_posted = False
+            msg.tts = tts
+            msg.geocode_future = geocode_future
+            self.recent_messages.put(key, msg)
+            self.scheduler.call_at(msg.timereceived + self.merge_window, self.post_message, msg)
+
+
+    def replay(self, filenames, speed):
+        """Feed recorded multimon-ng output through the pipeline and report the throughput."""
+
+        self.open_database()
+        log_message(f"Replaying {', '.join(filenames)} {f'at {speed}x speed' if speed else 'as fast as possible'}")
+
+        lines = 0
+        first_received = None
+        started = time.monotonic()
+        for received, line in read_replay_lines(filenames):
+            # Keep the original spacing between lines, scaled by speed, the merge windows and
+            # wait budgets run on the same clock so messages are posted like in a live run
+            if received is not None:
+                if first_received is None:
+                    first_received = received
+                    replay_started = self.clock()
+                self.replay_until(replay_started + (received - first_received) / (speed or 1), skip=not speed)
+
+            lines += 1
+            self.lines_read += 1
+            timer = self.timings.timer()
+            if line.__contains__("ALN"):
+                self.handle_line(line, timer)
+            self.scheduler.run_due()
+
+        # Post what is left, then the late locations update the sensors that were posted without one
+        self.replay_until(math.inf, skip=not speed)
+        self.geocoder.close()
+        self.replay_until(math.inf, skip=not speed)
+        self.database.close()
+        elapsed = time.monotonic() - started
+        # Also the messages posted from the scheduler
+        posted = self.timings.stats('latency')[0]
+
+        log_message(f"Replay finished: {lines} lines, {posted} messages in {elapsed:.2f} s")
+        if elapsed > 0:
+            log_message(f"Throughput: {lines / elapsed:.1f} lines/s, {posted / elapsed:.1f} messages/s")
+        log_message("Time spent per stage:")
+        for report_line in self.timings.report():
+            log_message(f"    {report_line}")
+        self.log_statistics()
+        self.mqtt_sender.close()
+
+
+    def log_statistics(self):
+        """Log the cache and decoder counters."""
+
+        if self.decoder:
+            status = self.decoder.status()
+            log_message(f"Decoder: {status['restarts']} restarts, {status['downtime']} s downtime, last exit code {status['last_exit_code']}")
+        count, mean, maximum = self.timings.stats('latency')
+        log_message(f"Posting latency: {count} messages, mean {mean * 1000:.0f} ms, max {maximum * 1000:.0f} ms")
+        stats = self.mqtt_sender.stats()
+        log_message(
+            f"MQTT: {stats['published']} published, {stats['acknowledged']} confirmed, {stats['reconnects']} reconnects, latency mean {stats['latency_mean'] * 1000:.1f} ms, max {stats['latency_max'] * 1000:.1f} ms"
+        )
+        log_message(
+            f"MQTT spool: {stats['queued']} queued, oldest {stats['queued_age']:.0f} s, "
+            f"{stats['coalesced']} coalesced, {stats['dropped']} dropped"
+        )
+        stats = self.recent_messages.stats()
+        log_message(f"Repeated messages: {stats['hits']} merged, {stats['size']} messages remembered")
+        stats = self.unknown_locations.stats()
+        log_message(f"Unknown location cache: {stats['size']} entries, {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+        stats = self.geocoder.stats()
+        log_message(
+            f"Geocode cache hit rates: memory {stats['memory']['hit_rate']:.0%} ({stats['memory']['hits']} hits), "
+            f"negative {stats['negative']['hit_rate']:.0%} ({stats['negative']['hits']} hits), "
+            f"postcodes {stats['postcode']['hit_rate']:.0%} ({stats['postcode']['hits']} hits, {stats['postcode']['areas']} areas), "
+            f"database {stats['database']['hit_rate']:.0%} ({stats['database']['hits']} hits), "
+            f"OpenCage {stats['opencage']['found']} found, {stats['opencage']['failed']} failed"
+        )
+
+
+    def collect_metrics(self):
+        """Return the pipeline metrics in the Prometheus text format, called by the metrics endpoint."""
+
+        metrics = PrometheusText()
+        histograms = self.timings.histograms()
+        latency = histograms.pop('latency', None)
+        metrics.histogram('p2000_stage_seconds', 'Time spent per message or line in each stage of the pipeline.',
+                          [({'stage': stage}, histogram) for stage, histogram in histograms.items()])
+        if latency:
+            metrics.histogram('p2000_message_latency_seconds', 'Time from receiving a message until it was posted.', [({}, latency)])
+        metrics.metric('p2000_lines_total', 'counter', 'Lines read from the decoder.', [({}, self.lines_read)])
+        metrics.metric('p2000_lines_malformed_total', 'counter', 'FLEX lines that could not be parsed.', [({}, self.lines_malformed)])
+        metrics.metric('p2000_messages_ignored_total', 'counter', 'Messages ignored by the global filters.',
+                       [({'filter': name}, count) for name, count in self.ignored.items()])
+        metrics.metric('p2000_messages_posted_total', 'counter', 'Messages checked against the sensors.', [({}, self.timings.stats('latency')[0])])
+        stats = self.recent_messages.stats()
+        metrics.metric('p2000_messages_merged_total', 'counter', 'Repeats merged into a message received before.', [({}, stats['hits'])])
+        metrics.metric('p2000_scheduler_wakeups_total', 'counter', 'Times the processing thread woke up to run its calls.', [({}, self.scheduler.wakeups)])
+
+        if self.database:
+            metrics.metric('p2000_database_flushes_total', 'counter', 'Batches of geocodes written to the database.', [({}, self.database.flushes)])
+
+        if self.geocoder:
+            stats = self.geocoder.stats()
+            stats['unknown_locations'] = self.unknown_locations.stats()
+            caches = ('memory', 'negative', 'postcode', 'database', 'unknown_locations')
+            metrics.metric('p2000_cache_hits_total', 'counter', 'Lookups answered by a cache.',
+                           [({'cache': cache}, stats[cache]['hits']) for cache in caches])
+            metrics.metric('p2000_cache_misses_total', 'counter', 'Lookups not answered by a cache.',
+                           [({'cache': cache}, stats[cache]['misses']) for cache in caches])
+            metrics.metric('p2000_opencage_requests_total', 'counter', 'OpenCage queries by result.',
+                           [({'result': 'found'}, stats['opencage']['found']), ({'result': 'failed'}, stats['opencage']['failed'])])
+
+        stats = self.mqtt_sender.stats()
+        metrics.histogram('p2000_mqtt_publish_seconds', 'Time until the broker had a publish, acknowledged for QoS 1.',
+                          [({}, histogram) for histogram in self.mqtt_sender.timings.histograms().values()])
+        metrics.metric('p2000_mqtt_connected', 'gauge', 'Whether the MQTT broker is connected.', [({}, stats['connected'])])
+        metrics.metric('p2000_mqtt_published_total', 'counter', 'Publishes handed to the MQTT client.', [({}, stats['published'])])
+        metrics.metric('p2000_mqtt_publish_failures_total', 'counter', 'Publishes the MQTT client did not accept, they were spooled.', [({}, stats['failed'])])
+        metrics.metric('p2000_mqtt_dropped_total', 'counter', 'Publishes dropped because the spool was full.', [({}, stats['dropped'])])
+        metrics.metric('p2000_mqtt_reconnects_total', 'counter', 'Reconnects to the MQTT broker.', [({}, stats['reconnects'])])
+        metrics.metric('p2000_mqtt_spool_messages', 'gauge', 'Publishes waiting in the spool.', [({}, stats['queued'])])
+        metrics.metric('p2000_mqtt_spool_age_seconds', 'gauge', 'Age of the oldest publish in the spool.', [({}, stats['queued_age'])])
+
+        if self.decoder:
+            status = self.decoder.status()
+            metrics.metric('p2000_decoder_restarts_total', 'counter', 'Restarts of the RTL-SDR decoder process.', [({}, status['restarts'])])
+            metrics.metric('p2000_decoder_downtime_seconds_total', 'counter', 'Time the decoder was not running.', [({}, status['downtime'])])
+            metrics.metric('p2000_decoder_receiving', 'gauge', 'Whether the decoder is running.', [({}, status['receiving'])])
+        return metrics.text()
+
+
+    def replay_until(self, until, skip):
+        """Run the calls that are due before until, or until none are left when until is math.inf.
+
+        With skip the clock jumps to the next deadline instead of waiting for it, but not while
+        OpenCage queries are running: in a live run they would have had that time.
+        """
+
+        while True:
+            self.scheduler.run_due()
+            now = self.clock()
+            deadline = self.scheduler.next_deadline()
+            busy = self.geocoder.busy()
+            if now >= until or (deadline is None and not busy and until == math.inf):
+                return
+            deadline = until if deadline is None else min(deadline, until)
+            if skip and not busy:
+                self.clock.skip_to(deadline)
+            else:
+                self.scheduler.wait(min(deadline - now, 1.0))
+
+
+    def post_message(self, msg):
+        """Post a message unless it was posted already, return True if it was posted now.
+
+        A message that is still being geocoded is posted when the location comes in
+        or the wait budget is used up, whichever comes first.
+        """
+
+        if msg.is_posted:
+            return False
+        future = msg.geocode_future
+        deadline = msg.timereceived + self.geocode_wait
+        if future is not None and not future.done() and self.clock() < deadline:
+            future.add_done_callback(lambda future: self.scheduler.call_soon(self.post_message, msg))
+            self.scheduler.call_at(deadline, self.post_message, msg)
+            return False
+
+        timer = self.timings.timer()
+        self.post_data(msg)
+        timer.lap('post')
+        self.timings.record('latency', self.clock() - msg.timereceived)
+        return True
+
+
+    def housekeeping(self):
+        """Flush the database and log the statistics every hour."""
+
+        # Scheduled again first, so an error below doesn't stop the housekeeping
+        now = self.clock()
+        self.scheduler.call_at(now + 60, self.housekeeping)
+        if self.database:
+            self.database.flush_if_due()
+        if now >= self.next_statistics:
+            self.next_statistics = now + 3600
+            self.log_statistics()
 
 
     def process_thread_call(self):
         """Thread for processing data."""
 
         log_message("Processing thread started")
-        while True:
-            if not self.running:
-                break
-
-            now = time.monotonic()
-            for msg in self.messages:
-                if msg.is_posted is False and now - msg.timereceived >= 1.0:
-                    self.post_data(msg)
-            time.sleep(1)
+        self.next_statistics = self.clock() + 3600
+        self.scheduler.call_at(self.clock() + 60, self.housekeeping)
+        # Sleeps until the merge window of the next message is over
+        self.scheduler.run()
 
         log_message("Processing thread stopped")
 
 
-# Start Add-on
-Main()
+if __name__ == '__main__':
+    # Create signal handlers/call back
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Start Add-on
+    Main(parse_arguments())
@@ -0,0 +1,108 @@
+"""In-memory index of the places table."""
+
+
+class CityMatcher:
+    """Aho-Corasick automaton that finds all known city names in a text in one pass."""
+
+    def __init__(self, names):
+        """Build the automaton for names."""
+
+        # Transitions of all states live in one dict keyed on (state << 21 | character),
+        # this takes a lot less memory than a dict per state on a small device
+        self.goto = {}
+        self.fail = [0]
+        self.output = [()]
+
+        for name in names:
+            state = 0
+            for char in name:
+                key = state << 21 | ord(char)
+                following = self.goto.get(key)
+                if following is None:
+                    following = len(self.fail)
+                    self.goto[key] = following
+                    self.fail.append(0)
+                    self.output.append(())
+                state = following
+            self.output[state] = ((len(name), name),)
+
+        # Breadth first, so the fail state of a parent is always known before its children
+        children = {}
+        for key, following in self.goto.items():
+            children.setdefault(key >> 21, []).append((key & 0x1FFFFF, following))
+        queue = [following for _, following in children.get(0, ())]
+        for state in queue:
+            for char, following in children.get(state, ()):
+                fallback = self.fail[state]
+                while fallback and (fallback << 21 | char) not in self.goto:
+                    fallback = self.fail[fallback]
+                fail = self.goto.get(fallback << 21 | char, 0)
+                self.fail[following] = fail
+                self.output[following] = self.output[following] + self.output[fail]
+                queue.append(following)
+
+    def finditer(self, text):
+        """Yield (start, end, name) for every occurrence of a name in text."""
+
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for end, char in enumerate(text, 1):
+            code = ord(char)
+            following = goto.get(state << 21 | code)
+            while following is None and state:
+                state = fail[state]
+                following = goto.get(state << 21 | code)
+            state = following or 0
+            for length, name in output[state]:
+                yield end - length, end, name
+
+
+class PlaceIndex:
+    """Cities and their abbreviations, with a matcher to find cities in a message."""
+
+    def __init__(self, rows):
+        """Build the index from (city, abbreviation) rows."""
+
+        self.cities = set()
+        self.abbreviations = {}
+        for city, abbreviation in rows:
+            if city:
+                self.cities.add(city)
+                if abbreviation:
+                    self.abbreviations.setdefault(abbreviation, city)
+        self.matcher = CityMatcher(self.cities)
+
+    def __len__(self):
+        return len(self.cities)
+
+    def is_city(self, name):
+        """Return True if name is a known city."""
+
+        return name in self.cities
+
+    def find_city(self, abbreviation):
+        """Return the full city name for an abbreviation, or None."""
+
+        return self.abbreviations.get(abbreviation)
+
+    def find_cities(self, text):
+        """Return the cities mentioned in text as whole words, in order of appearance.
+
+        A city name that is part of a longer city name found at the same spot is left out.
+        """
+
+        found = []
+        for start, end, name in self.matcher.finditer(text):
+            if start > 0 and text[start - 1].isalnum():
+                continue
+            if end < len(text) and text[end].isalnum():
+                continue
+            # Drop earlier matches that lie inside this one, skip this one if it lies inside an earlier one
+            while found and found[-1][0] >= start:
+                found.pop()
+            if found and found[-1][1] >= end:
+                continue
+            found.append((start, end, name))
+        return [name for _, _, name in found]
@@ -0,0 +1,119 @@
+"""Deadline ordered scheduler for the processing thread."""
+import heapq
+import itertools
+import threading
+import time
+
+from utils import log_message
+
+
+class ReplayClock:
+    """time.monotonic() that can skip ahead, so a replay doesn't sit out the quiet time of a recording."""
+
+    def __init__(self):
+        """Start at time.monotonic()."""
+
+        self.offset = 0.0
+
+    def __call__(self):
+        return time.monotonic() + self.offset
+
+    def skip_to(self, when):
+        """Move the clock forward to when, it never goes back."""
+
+        now = self()
+        if when > now:
+            self.offset += when - now
+
+
+class DeadlineScheduler:
+    """Run calls at their deadline, the thread running them sleeps until the first one is due."""
+
+    def __init__(self, clock=time.monotonic):
+        """Initialize an empty schedule, the deadlines are values of clock."""
+
+        self.clock = clock
+        self.heap = []
+        # Tie breaker, calls with the same deadline run in the order they were added
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.wakeups = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def call_at(self, deadline, function, *args):
+        """Run function(*args) at deadline, a value of the clock."""
+
+        entry = (deadline, next(self.counter), function, args)
+        with self.condition:
+            heapq.heappush(self.heap, entry)
+            # Only a new first deadline changes how long the thread has to sleep
+            if self.heap[0] is entry:
+                self.condition.notify()
+
+    def call_soon(self, function, *args):
+        """Run function(*args) as soon as possible."""
+
+        self.call_at(self.clock(), function, *args)
+
+    def close(self):
+        """Stop run(), calls that are not due yet are dropped."""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def next_deadline(self):
+        """Return the deadline of the first call, None when there are none."""
+
+        with self.condition:
+            return self.heap[0][0] if self.heap else None
+
+    def wait(self, timeout):
+        """Sleep for timeout seconds at most, a new first call wakes it up earlier."""
+
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def pop_due(self, now):
+        """Remove and return the calls that are due at now."""
+
+        due = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+        return due
+
+    def run_due(self, now=None):
+        """Run all calls that are due, return how many ran."""
+
+        due = self.pop_due(self.clock() if now is None else now)
+        for _, _, function, args in due:
+            self.execute(function, args)
+        return len(due)
+
+    def run(self):
+        """Run calls at their deadline until close() is called."""
+
+        while True:
+            with self.condition:
+                while not self.closed:
+                    timeout = self.heap[0][0] - self.clock() if self.heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                    self.wakeups += 1
+                if self.closed:
+                    return
+            self.run_due()
+
+    @staticmethod
+    def execute(function, args):
+        """Run one call, an error doesn't stop the other calls."""
+
+        try:
+            function(*args)
+        except Exception as err:
+            log_message(f"{type(err).__name__}: '{err}' occurred in {function.__name__}", True)
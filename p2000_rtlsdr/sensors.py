@@ -0,0 +1,187 @@
+"""Sensor criteria, compiled once when the configuration is loaded."""
+import fnmatch
+import re
+from itertools import chain
+
+from utils import log_message
+
+# Criteria in the order they are checked: (config key, log label, message field, field holds a list)
+CRITERIA = (
+    ('keyword', 'Keywords', 'body', False),
+    ('region', 'Regions', 'region', False),
+    ('location', 'Locations', 'location', False),
+    ('remark', 'Remarks', 'remarks', False),
+    ('capcode', 'Capcodes', 'capcodes', True),
+    ('discipline', 'Disciplines', 'disciplines', True),
+)
+
+# Fields that can be looked up in the SensorIndex, the most selective first
+INDEXED_FIELDS = ('capcodes', 'region', 'disciplines')
+
+WILDCARD_RE = re.compile(r"[*?[]")
+
+# Capcodes are 9 digits, so a pattern like '*001420059*' only matches that capcode
+CAPCODE_LENGTH = 9
+
+
+def compile_patterns(text):
+    """Return one regex that matches when any of the comma separated fnmatch patterns in text matches."""
+
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in str(text).split(',')))
+
+
+class Criterion:
+    """One compiled filter of a sensor."""
+
+    __slots__ = ('label', 'field', 'many', 'patterns', 'match')
+
+    def __init__(self, label, field, many, text):
+        self.label = label
+        self.field = field
+        self.many = many
+        self.patterns = str(text).split(',')
+        self.match = compile_patterns(text).match
+
+    def matches(self, msg):
+        """Return True if the field of msg matches one of the patterns."""
+
+        value = getattr(msg, self.field)
+        if self.many:
+            match = self.match
+            return any(match(item) for item in value)
+        return self.match(value) is not None
+
+
+class SensorMatcher:
+    """The criteria of one sensor, a message has to match all of them."""
+
+    def __init__(self, id, sensor):
+        """Compile the criteria of a sensor config."""
+
+        self.id = id
+        self.zone_coordinates = None
+        self.zone_radius = None
+        if "zone_latitude" in sensor and "zone_longitude" in sensor and "zone_radius" in sensor:
+            self.zone_coordinates = (float(sensor['zone_latitude']), float(sensor['zone_longitude']))
+            self.zone_radius = float(sensor['zone_radius'])
+        # Polygons from a GeoJSON file, checked by PolygonZones
+        self.zone_geojson = sensor.get('zone_geojson')
+
+        self.criteria = tuple(
+            Criterion(label, field, many, sensor[key])
+            for key, label, field, many in CRITERIA if key in sensor
+        )
+
+    def criterion(self, field):
+        """Return the criterion for a message field, None if the sensor doesn't filter on it."""
+
+        for criterion in self.criteria:
+            if criterion.field == field:
+                return criterion
+        return None
+
+    def match(self, msg, debug=False):
+        """Return True if msg matches this sensor.
+
+        The zones are only checked when the location of the message is known, msg.distances
+        has to be filled in by CircleZones and PolygonZones by then. At least one checked
+        criterion has to match.
+        """
+
+        checked = False
+        if self.zone_coordinates is not None and msg.latitude and msg.longitude:
+            # Measured for all zones at once by CircleZones, zones that are far away are left out
+            distance = msg.distances.get(self.id)
+            if distance is None or distance > self.zone_radius:
+                if debug:
+                    if distance is None:
+                        log_message(f"Distance UNMATCHED, more than {self.zone_radius} km away")
+                    else:
+                        log_message(f"Distance UNMATCHED {distance} km, outside {self.zone_radius} km radius")
+                return False
+            if debug:
+                log_message(f"Distance MATCHED {distance} km, inside {self.zone_radius} km radius")
+            checked = True
+
+        if self.zone_geojson is not None and msg.latitude and msg.longitude:
+            # PolygonZones gives the zones that contain the location distance 0
+            if self.id not in msg.distances:
+                if debug:
+                    log_message(f"Zone UNMATCHED, outside '{self.zone_geojson}'")
+                return False
+            if debug:
+                log_message(f"Zone MATCHED, inside '{self.zone_geojson}'")
+            checked = True
+
+        for criterion in self.criteria:
+            if not criterion.matches(msg):
+                if debug:
+                    log_message(f"{criterion.label} UNMATCHED '{', '.join(criterion.patterns)}'")
+                return False
+            if debug:
+                log_message(f"{criterion.label} MATCHED '{', '.join(criterion.patterns)}'")
+            checked = True
+
+        if not checked and debug:
+            log_message("Message IGNORED no criterias matched")
+        return checked
+
+
+def exact_keys(criterion):
+    """Return the values that the patterns of a criterion match, None if one of them is a wildcard."""
+
+    keys = []
+    for pattern in criterion.patterns:
+        if criterion.field == 'capcodes':
+            capcode = pattern.strip('*')
+            if len(capcode) == CAPCODE_LENGTH and capcode.isdigit():
+                keys.append(capcode)
+                continue
+        if WILDCARD_RE.search(pattern):
+            return None
+        keys.append(pattern)
+    return keys
+
+
+class SensorIndex:
+    """Finds the sensors a message can match without checking all of them.
+
+    Every sensor is filed under the exact capcodes, region or disciplines it
+    filters on. Sensors with only wildcard patterns for those (or none of
+    them at all) are checked for every message.
+    """
+
+    def __init__(self, matchers):
+        """Build the index from a dict of id: SensorMatcher, in config order."""
+
+        self.order = {id: position for position, id in enumerate(matchers)}
+        self.indexes = {field: {} for field in INDEXED_FIELDS}
+        self.fallback = []
+        for id, matcher in matchers.items():
+            for field in INDEXED_FIELDS:
+                criterion = matcher.criterion(field)
+                keys = exact_keys(criterion) if criterion else None
+                if keys is not None:
+                    index = self.indexes[field]
+                    for key in keys:
+                        index.setdefault(key, []).append(id)
+                    break
+            else:
+                self.fallback.append(id)
+
+    def __len__(self):
+        return len(self.order)
+
+    def candidates(self, msg):
+        """Return the ids of the sensors msg can match, in config order."""
+
+        capcodes = self.indexes['capcodes']
+        # A longer capcode than usual could contain an indexed one, check everything
+        if any(len(capcode) > CAPCODE_LENGTH for capcode in msg.capcodes):
+            return list(self.order)
+        found = set(self.fallback)
+        found.update(chain.from_iterable(capcodes.get(capcode, ()) for capcode in msg.capcodes))
+        found.update(self.indexes['region'].get(msg.region, ()))
+        disciplines = self.indexes['disciplines']
+        found.update(chain.from_iterable(disciplines.get(discipline, ()) for discipline in msg.disciplines))
+        return sorted(found, key=self.order.__getitem__)
@@ -0,0 +1,94 @@
+"""Durable outbound spool for MQTT publishes that could not be sent."""
+import sqlite3
+import threading
+import time
+
+from utils import log_message
+
+
+class Spool:
+    """SQLite queue of publishes, kept on disk until the broker has them.
+
+    A retained publish replaces the spooled retained publish to the same topic,
+    the broker only keeps the last one anyway. Other publishes (the alerts) are
+    all kept, when there are more than max_messages the oldest ones are dropped.
+    """
+
+    def __init__(self, path, max_messages=10000):
+        """Open or create the spool."""
+
+        self.path = path
+        self.max_messages = max_messages
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.coalesced = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, payload BLOB, "
+            "qos INTEGER NOT NULL, retain INTEGER NOT NULL, created REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_retained ON outbox (topic) WHERE retain = 1")
+        self.db.commit()
+        self.count = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if self.count:
+            log_message(f"MQTT spool '{path}' has {self.count} messages from before, they are sent after connecting")
+
+    def __len__(self):
+        return self.count
+
+    def put(self, topic, payload, qos, retain):
+        """Store a publish."""
+
+        with self.lock, self.db:
+            if retain:
+                replaced = self.db.execute("DELETE FROM outbox WHERE retain = 1 AND topic = ?", (topic,)).rowcount
+                self.coalesced += replaced
+                self.count -= replaced
+            self.db.execute(
+                "INSERT INTO outbox (topic, payload, qos, retain, created) VALUES (?, ?, ?, ?, ?)",
+                (topic, payload, qos, int(retain), time.time())
+            )
+            self.count += 1
+            if self.count > self.max_messages:
+                over = self.count - self.max_messages
+                self.db.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (over,))
+                self.dropped += over
+                self.count -= over
+
+    def peek(self, limit, after=0):
+        """Return up to limit of the oldest publishes after row id after as (id, topic, payload, qos, retain) rows."""
+
+        with self.lock:
+            return self.db.execute(
+                "SELECT id, topic, payload, qos, retain FROM outbox WHERE id > ? ORDER BY id LIMIT ?", (after, limit)
+            ).fetchall()
+
+    def remove(self, ids):
+        """Remove publishes the broker acknowledged."""
+
+        if not ids:
+            return
+        with self.lock, self.db:
+            self.count -= self.db.executemany("DELETE FROM outbox WHERE id = ?", ((id,) for id in ids)).rowcount
+
+    def discard(self, topic):
+        """Remove all spooled publishes to a topic."""
+
+        with self.lock, self.db:
+            self.count -= self.db.execute("DELETE FROM outbox WHERE topic = ?", (topic,)).rowcount
+
+    def age(self):
+        """Return the age in seconds of the oldest publish, 0 when the spool is empty."""
+
+        with self.lock:
+            row = self.db.execute("SELECT created FROM outbox ORDER BY id LIMIT 1").fetchone()
+        return max(time.time() - row[0], 0.0) if row else 0.0
+
+    def close(self):
+        """Close the database, what is left is sent after the next start."""
+
+        with self.lock:
+            self.db.close()
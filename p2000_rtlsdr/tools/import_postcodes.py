@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Fill the postcodes and streets tables of p2000.sqlite3 from a list of addresses.
+
+The input is a CSV file with one row per address, like the Dutch addresses of
+OpenAddresses (columns LON, LAT, STREET, CITY, POSTCODE) or an export of the
+BAG with columns longitude, latitude, street, city, postcode. The centroid of
+all addresses is stored per full postcode (PC6), per postcode number (PC4)
+and per street in a city.
+
+Usage: python3 import_postcodes.py addresses.csv [p2000.sqlite3]
+"""
+import csv
+import sqlite3
+import sys
+from collections import Counter, defaultdict
+
+COLUMNS = {
+    'postcode': ('postcode', 'POSTCODE'),
+    'street': ('street', 'STREET'),
+    'city': ('city', 'CITY'),
+    'latitude': ('latitude', 'lat', 'LAT'),
+    'longitude': ('longitude', 'lon', 'LON'),
+}
+
+
+class Centroid:
+    """Running mean of coordinates, with the most common city."""
+
+    __slots__ = ('latitude', 'longitude', 'count', 'cities')
+
+    def __init__(self):
+        self.latitude = 0.0
+        self.longitude = 0.0
+        self.count = 0
+        self.cities = Counter()
+
+    def add(self, latitude, longitude, city):
+        self.latitude += latitude
+        self.longitude += longitude
+        self.count += 1
+        self.cities[city] += 1
+
+    def row(self):
+        city = self.cities.most_common(1)[0][0]
+        return city, round(self.latitude / self.count, 6), round(self.longitude / self.count, 6)
+
+
+def find_columns(header):
+    """Return the index of every column we need."""
+
+    columns = {}
+    for name, candidates in COLUMNS.items():
+        for candidate in candidates:
+            if candidate in header:
+                columns[name] = header.index(candidate)
+                break
+        else:
+            sys.exit(f"Column '{name}' not found in the header, expected one of {', '.join(candidates)}")
+    return columns
+
+
+def read_addresses(filename):
+    """Return the centroids per postcode and per (city, street)."""
+
+    postcodes = defaultdict(Centroid)
+    streets = defaultdict(Centroid)
+    with open(filename, encoding='utf8', newline='') as f:
+        reader = csv.reader(f)
+        columns = find_columns(next(reader))
+        for row in reader:
+            try:
+                latitude = float(row[columns['latitude']])
+                longitude = float(row[columns['longitude']])
+            except (IndexError, ValueError):
+                continue
+            postcode = row[columns['postcode']].replace(" ", "").upper()
+            street = row[columns['street']].strip()
+            city = row[columns['city']].strip()
+            if len(postcode) == 6:
+                postcodes[postcode].add(latitude, longitude, city)
+            if len(postcode) >= 4:
+                postcodes[postcode[:4]].add(latitude, longitude, city)
+            if street and city:
+                streets[(city, street)].add(latitude, longitude, city)
+    return postcodes, streets
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    database = sys.argv[2] if len(sys.argv) > 2 else 'p2000.sqlite3'
+
+    postcodes, streets = read_addresses(sys.argv[1])
+    db = sqlite3.connect(database)
+    db.execute("CREATE TABLE IF NOT EXISTS postcodes (postcode TEXT PRIMARY KEY, city TEXT, latitude REAL, longitude REAL) WITHOUT ROWID")
+    db.execute("CREATE TABLE IF NOT EXISTS streets (city TEXT, street TEXT, latitude REAL, longitude REAL, PRIMARY KEY (city, street)) WITHOUT ROWID")
+    with db:
+        db.execute("DELETE FROM postcodes")
+        db.execute("DELETE FROM streets")
+        db.executemany("INSERT INTO postcodes VALUES (?,?,?,?)", ((postcode, *centroid.row()) for postcode, centroid in postcodes.items()))
+        db.executemany("INSERT INTO streets VALUES (?,?,?,?)", ((city, street, *centroid.row()[1:]) for (city, street), centroid in streets.items()))
+    db.execute("VACUUM")
+    db.close()
+    print(f"Stored {len(postcodes)} postcodes and {len(streets)} streets in '{database}'")
+
+
+if __name__ == '__main__':
+    main()
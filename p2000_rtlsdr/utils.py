@@ -0,0 +1,12 @@
+"""Helpers shared by the P2000 add-on modules."""
+import sys
+from datetime import datetime
+
+
+def log_message(message, log=True):
+    """Function to log messages to STDERR."""
+
+    if log == True:
+        now = datetime.now()
+        dt_string = now.strftime("%Y-%m-%d %H:%M:%S")
+        print(f'{dt_string}: {message}', file=sys.stderr)
@@ -0,0 +1,264 @@
+"""Geofences of the zone sensors, circles and polygons."""
+import json
+import math
+import os
+from bisect import bisect_right
+
+from geopy.distance import geodesic
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Mean earth radius in km, haversine differs less than 0.6% from the ellipsoid
+EARTH_RADIUS = 6371.0088
+# Zones this much further away than their radius can't match, the rest is measured exactly
+HAVERSINE_MARGIN = 1.01
+
+
+class CircleZones:
+    """All circular zones, checked against a location in one pass.
+
+    A haversine distance to every centre sorts out the zones that are clearly too
+    far away, that is one vectorized pass with numpy or a plain loop without it.
+    Only the zones that are left get the exact (and slow) geodesic distance.
+    """
+
+    def __init__(self, zones):
+        """Build the arrays from (id, latitude, longitude, radius in km) tuples."""
+
+        self.ids = [id for id, _, _, _ in zones]
+        self.centres = [(latitude, longitude) for _, latitude, longitude, _ in zones]
+        self.radii = [radius for _, _, _, radius in zones]
+        latitudes = [math.radians(latitude) for latitude, _ in self.centres]
+        longitudes = [math.radians(longitude) for _, longitude in self.centres]
+        if numpy is not None:
+            self.latitudes = numpy.array(latitudes)
+            self.longitudes = numpy.array(longitudes)
+            self.cos_latitudes = numpy.cos(self.latitudes)
+            self.limits = numpy.array(self.radii) * HAVERSINE_MARGIN
+        else:
+            self.latitudes = latitudes
+            self.longitudes = longitudes
+            self.cos_latitudes = [math.cos(latitude) for latitude in latitudes]
+            self.limits = [radius * HAVERSINE_MARGIN for radius in self.radii]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def haversine(self, latitude, longitude):
+        """Return the approximate distance in km from every centre to a location."""
+
+        latitude = math.radians(latitude)
+        longitude = math.radians(longitude)
+        cos_latitude = math.cos(latitude)
+        if numpy is not None:
+            a = (numpy.sin((self.latitudes - latitude) / 2) ** 2
+                 + self.cos_latitudes * cos_latitude * numpy.sin((self.longitudes - longitude) / 2) ** 2)
+            return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+        return [
+            2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, math.sin((zone_latitude - latitude) / 2) ** 2
+                                                       + zone_cos * cos_latitude * math.sin((zone_longitude - longitude) / 2) ** 2)))
+            for zone_latitude, zone_longitude, zone_cos in zip(self.latitudes, self.longitudes, self.cos_latitudes)
+        ]
+
+    def check(self, latitude, longitude):
+        """Return a dict of id: exact distance in km, for the zones that are near enough to be inside.
+
+        Zones missing from the result are too far away.
+        """
+
+        if not self.ids:
+            return {}
+        latitude = float(latitude)
+        longitude = float(longitude)
+        approximations = self.haversine(latitude, longitude)
+        if numpy is not None:
+            near = numpy.flatnonzero(approximations <= self.limits).tolist()
+        else:
+            near = [number for number, (distance, limit) in enumerate(zip(approximations, self.limits)) if distance <= limit]
+        return {
+            self.ids[number]: round(geodesic(self.centres[number], (latitude, longitude)).km, 2)
+            for number in near
+        }
+
+
+# Folders a relative zone_geojson path is looked up in
+GEOJSON_FOLDERS = ('/config', '/share')
+
+
+def find_geojson(filename):
+    """Return the path of a GeoJSON file, relative names are looked up in /config and /share."""
+
+    if os.path.isabs(filename):
+        return filename
+    for folder in GEOJSON_FOLDERS:
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            return path
+    return os.path.join(GEOJSON_FOLDERS[0], filename)
+
+
+def load_geojson(filename, feature=None):
+    """Return the rings of all polygons in a GeoJSON file as lists of (longitude, latitude).
+
+    With feature only the features that have a property with that value are used.
+    """
+
+    with open(find_geojson(filename), encoding='utf8') as f:
+        data = json.load(f)
+
+    if data.get('type') == 'FeatureCollection':
+        features = data.get('features', [])
+    elif data.get('type') == 'Feature':
+        features = [data]
+    else:
+        features = [{'geometry': data, 'properties': {}}]
+
+    rings = []
+    for item in features:
+        if feature is not None and feature not in (str(value) for value in (item.get('properties') or {}).values()):
+            continue
+        geometry = item.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        for polygon in polygons:
+            for ring in polygon:
+                rings.append([(float(point[0]), float(point[1])) for point in ring])
+    return rings
+
+
+def crosses(edges, x, y):
+    """Return True if a ray from (x, y) to the east crosses the edges an odd number of times."""
+
+    inside = False
+    for x1, y1, x2, y2 in edges:
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+
+def crosses_path(edges, x, y, centre_x, centre_y):
+    """Return True if the path from (x, y) east or west to centre_x, then north or south to
+    centre_y crosses the edges an odd number of times."""
+
+    inside = False
+    west, east = (x, centre_x) if x < centre_x else (centre_x, x)
+    south, north = (y, centre_y) if y < centre_y else (centre_y, y)
+    for x1, y1, x2, y2 in edges:
+        if (y1 > y) != (y2 > y) and west <= (x2 - x1) * (y - y1) / (y2 - y1) + x1 < east:
+            inside = not inside
+        if (x1 > centre_x) != (x2 > centre_x) and south <= (y2 - y1) * (centre_x - x1) / (x2 - x1) + y1 < north:
+            inside = not inside
+    return inside
+
+
+class PolygonZones:
+    """Polygon zones in a uniform grid over all of them.
+
+    Every grid cell lists the zones it is (partly) inside of. A location in a
+    cell that is completely inside a zone matches right away. A cell on the
+    border of a zone knows if its centre is inside and the edges that touch it,
+    the location is inside when the path from it to the centre crosses an even
+    number of those edges.
+    """
+
+    def __init__(self, zones, cells=1):
+        """Build the grid from (id, rings) tuples, with about cells grid cells per edge."""
+
+        self.ids = [id for id, _ in zones]
+        self.grid = {}
+        points = [point for _, rings in zones for ring in rings for point in ring]
+        if not points:
+            self.columns = self.rows = 0
+            return
+        self.west = min(x for x, _ in points)
+        self.south = min(y for _, y in points)
+        width = max(max(x for x, _ in points) - self.west, 1e-9)
+        height = max(max(y for _, y in points) - self.south, 1e-9)
+        # Square cells, as many as there are edges times cells, but not more than 1024 in either direction
+        size = max(math.sqrt(width * height / (len(points) * cells)), width / 1024, height / 1024)
+        self.size = size
+        self.columns = min(int(width / size) + 1, 1024)
+        self.rows = min(int(height / size) + 1, 1024)
+
+        for id, rings in zones:
+            self.add_zone(id, rings)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def cell(self, x, y):
+        """Return the column and row of a location, may be outside the grid."""
+
+        return int((x - self.west) / self.size), int((y - self.south) / self.size)
+
+    def add_zone(self, id, rings):
+        """Add the cells of one zone to the grid."""
+
+        edges = [
+            (x1, y1, x2, y2)
+            for ring in rings
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1])
+            if (x1, y1) != (x2, y2)
+        ]
+        if not edges:
+            return
+
+        # The edges per row of cells, and the edges in the cells an edge (its bounding box) touches
+        row_edges = {}
+        border = {}
+        for edge in edges:
+            x1, y1, x2, y2 = edge
+            first_column, first_row = self.cell(min(x1, x2), min(y1, y2))
+            last_column, last_row = self.cell(max(x1, x2), max(y1, y2))
+            # Rounding can put the far side of the grid just outside it
+            first_column, last_column = min(first_column, self.columns - 1), min(last_column, self.columns - 1)
+            first_row, last_row = min(first_row, self.rows - 1), min(last_row, self.rows - 1)
+            for row in range(first_row, last_row + 1):
+                row_edges.setdefault(row, []).append(edge)
+                cells = border.setdefault(row, {})
+                for column in range(first_column, last_column + 1):
+                    cells.setdefault(column, []).append(edge)
+
+        for row, edges_in_row in row_edges.items():
+            cells = border[row]
+            # The centre line of the row crosses the edges at these points,
+            # so the centre of a cell is inside after an odd number of them
+            y = self.south + (row + 0.5) * self.size
+            crossings = sorted(
+                (x2 - x1) * (y - y1) / (y2 - y1) + x1
+                for x1, y1, x2, y2 in edges_in_row if (y1 > y) != (y2 > y)
+            )
+            for column in range(min(cells), max(cells) + 1):
+                inside = bisect_right(crossings, self.west + (column + 0.5) * self.size) % 2 == 1
+                if column in cells:
+                    self.grid.setdefault(row * self.columns + column, []).append((id, inside, tuple(cells[column])))
+                # The other cells are inside or outside as a whole
+                elif inside:
+                    self.grid.setdefault(row * self.columns + column, []).append((id, True, None))
+
+    def check(self, latitude, longitude):
+        """Return the ids of the zones that contain the location."""
+
+        if not self.grid:
+            return []
+        x = float(longitude)
+        y = float(latitude)
+        column, row = self.cell(x, y)
+        if not (0 <= column < self.columns and 0 <= row < self.rows):
+            return []
+        entries = self.grid.get(row * self.columns + column)
+        if not entries:
+            return []
+        centre_x = self.west + (column + 0.5) * self.size
+        centre_y = self.south + (row + 0.5) * self.size
+        return [
+            id for id, inside, edges in entries
+            if edges is None or inside != crosses_path(edges, x, y, centre_x, centre_y)
+        ]